@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+# Ways to reach a cell of the alignment
+_DIAGONAL = 0  # the variant word matches (or replaces) the template word
+_DELETE = 1  # the template word is missing from the variant
+_INSERT = 2  # the variant word is not in the template
+_ABSORB = 3  # the variant word is part of the value of a template slot
+# Ways for a slot to absorb a variant word
+_START = 0  # the first word of the slot's value
+_CONTINUE = 1  # a later word of the slot's value
+
+_INFINITY = 2 ** 30
+
+
+def is_slot(word):
+    return word[:1] == "{" and word[-1:] == "}"
+
+
+# Aligns the words of a variant with the words of a template using a word
+# level edit distance, where substituting, inserting or deleting a word
+# costs 1. A slot in the template (like "{Duration}") matches the same
+# slot in the variant, where a keyword value has already been recognized.
+# An open slot (one without a list of values, like a regex or free text
+# keyword) can also take a run of one or more of the variant's other
+# words as its value at no cost:
+#   variant:  SET A TIMER FOR FIVE MINUTES
+#   template: SET A TIMER FOR {Duration}
+#   distance: 0, slots: [(4, 4, 6)] ({Duration} took "FIVE MINUTES")
+# When taking words for a slot costs the same as substituting them, the
+# slot gets them, so a slot's value is kept whole when the word before it
+# was dropped:
+#   variant:  SET A TIMER FIVE MINUTES
+#   distance: 1, slots: [(4, 3, 5)] ({Duration} took "FIVE MINUTES")
+# The words can be strings or tokens from a TokenTable, as long as
+# is_slot() can tell which of them are slots. is_open() tells which slots
+# are open, and by default they all are.
+# The cost matrix and the matrices used to trace the alignment back are
+# kept between calls and only grown when needed, since the same aligner
+# is used for every template of every utterance.
+class Aligner(object):
+    def __init__(self):
+        self._size = 0
+        self._costs = array('i')  # the cheapest alignment of each prefix
+        self._absorbing = array('i')  # the same, ending inside a slot
+        self._moves = bytearray()
+        self._absorb_moves = bytearray()
+
+    def _reserve(self, size):
+        if size > self._size:
+            grow = size - self._size
+            self._costs.extend([0] * grow)
+            self._absorbing.extend([0] * grow)
+            self._moves.extend(bytes(grow))
+            self._absorb_moves.extend(bytes(grow))
+            self._size = size
+
+    # Returns the distance between the variant and the template, and a
+    # list of (template position, start, end) for every template slot that
+    # took some of the variant's words (variant[start:end]) as its value,
+    # in template order.
+    def align(self, variant, template, is_slot=is_slot, is_open=None):
+        n = len(variant)
+        m = len(template)
+        width = m + 1
+        self._reserve((n + 1) * width)
+        costs = self._costs
+        absorbing = self._absorbing
+        moves = self._moves
+        absorb_moves = self._absorb_moves
+        slots = [
+            is_slot(word) and (is_open is None or is_open(word))
+            for word in template
+        ]
+        for j in range(width):
+            costs[j] = j
+            absorbing[j] = _INFINITY
+            moves[j] = _DELETE
+        for i in range(1, n + 1):
+            word = variant[i - 1]
+            word_is_slot = is_slot(word)
+            row = i * width
+            above = row - width
+            costs[row] = i
+            absorbing[row] = _INFINITY
+            moves[row] = _INSERT
+            for j in range(1, width):
+                cell = row + j
+                best = costs[above + j - 1]
+                if word != template[j - 1]:
+                    best += 1
+                move = _DIAGONAL
+                if costs[cell - 1] + 1 < best:
+                    best = costs[cell - 1] + 1
+                    move = _DELETE
+                if costs[above + j] + 1 < best:
+                    best = costs[above + j] + 1
+                    move = _INSERT
+                if slots[j - 1] and not word_is_slot:
+                    # Start a new value for the slot here, or carry on
+                    # with the value it already has. On a tie, carry on
+                    # and give the word to the slot, so words that could
+                    # belong to either the slot or a substitution before
+                    # it stay part of the slot's value.
+                    absorb = costs[above + j - 1]
+                    absorb_moves[cell] = _START
+                    if absorbing[above + j] <= absorb:
+                        absorb = absorbing[above + j]
+                        absorb_moves[cell] = _CONTINUE
+                    absorbing[cell] = absorb
+                    # The slot also gets the word on a tie, unless the
+                    # other way matches the word with the template and
+                    # leaves the slot empty, so the slot doesn't take
+                    # words like the "FOR" of "SET A TIMER FOR".
+                    if absorb < best or (absorb == best and move != _DELETE):
+                        best = absorb
+                        move = _ABSORB
+                else:
+                    absorbing[cell] = _INFINITY
+                costs[cell] = best
+                moves[cell] = move
+        # Trace the alignment back from the end to find the slot values
+        values = []
+        i = n
+        j = m
+        while i > 0 and j > 0:
+            move = moves[i * width + j]
+            if move == _DIAGONAL:
+                i -= 1
+                j -= 1
+            elif move == _DELETE:
+                j -= 1
+            elif move == _INSERT:
+                i -= 1
+            else:
+                end = i
+                while absorb_moves[i * width + j] == _CONTINUE:
+                    i -= 1
+                i -= 1
+                j -= 1
+                values.append((j, i, end))
+        values.reverse()
+        return costs[n * width + m], values
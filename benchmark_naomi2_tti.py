@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# Benchmarks the Naomi2 TTI plugin against synthetic sets of intents.
+#
+# Run it from a checkout of the plugin, with Naomi installed:
+#   python benchmark_naomi2_tti.py --intents 10 100 500 --output before.json
+#   (make some changes)
+#   python benchmark_naomi2_tti.py --intents 10 100 500 --output after.json \
+#       --compare before.json
+# For each intent count it times add_intents(), train(),
+# get_plugin_phrases() and determine_intent() (as p50/p95/p99 of the time
+# per utterance), and measures the peak memory used by each stage.
+#
+# naomi.profile and naomi.paths are replaced by stubs, so the benchmark
+# does not need a Naomi profile or data directory and never touches them.
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+# Words that show up in a lot of templates, like they do in real plugins,
+# so the benchmark also covers words with low weights.
+COMMON_WORDS = [
+    "WHAT", "IS", "THE", "A", "TO", "PLAY", "SET", "TELL", "ME", "MY"
+]
+
+
+# A stand in for naomi.profile, holding just the settings the plugin reads
+class ProfileStub(types.ModuleType):
+    def __init__(self, settings):
+        super().__init__("naomi.profile")
+        self.settings = settings
+
+    def get(self, path, default=None):
+        if isinstance(path, str):
+            path = [path]
+        value = self.settings
+        for key in path:
+            try:
+                value = value[key]
+            except (KeyError, TypeError):
+                return default
+        return value
+
+
+# A stand in for naomi.paths, keeping data in a temporary directory
+class PathsStub(types.ModuleType):
+    def __init__(self, directory):
+        super().__init__("naomi.paths")
+        self.directory = directory
+
+    def data(self, *args):
+        return os.path.join(self.directory, *args)
+
+
+def load_plugin(settings, directory):
+    import naomi
+    naomi.profile = sys.modules["naomi.profile"] = ProfileStub(settings)
+    naomi.paths = sys.modules["naomi.paths"] = PathsStub(directory)
+    # Load the plugin as a package straight from this directory, so the
+    # benchmark works wherever the plugin is checked out
+    here = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(
+        "naomi2_tti_benchmark",
+        os.path.join(here, "__init__.py"),
+        submodule_search_locations=[here]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = package
+    spec.loader.exec_module(package)
+    return package.Naomi2TTIPlugin
+
+
+def handle(intent, mic):
+    pass
+
+
+def make_words(rng, count, prefix):
+    return ["{}{}".format(prefix, number) for number in rng.sample(range(count * 10), count)]
+
+
+# Build a set of intents in the format plugins pass to add_intents(). Each
+# intent gets its own keyword groups with values of one to three words,
+# and templates mixing common words, words of its own and its keywords.
+def make_intents(rng, intents, templates, keyword_groups, keyword_values):
+    vocabulary = make_words(rng, max(intents * 5, 50), "W")
+    result = {}
+    for number in range(intents):
+        keywords = {}
+        for group in range(keyword_groups):
+            keywords["Keyword{}".format(group)] = [
+                " ".join(rng.choice(vocabulary) for i in range(rng.randint(1, 3)))
+                for value in range(keyword_values)
+            ]
+        own_words = rng.sample(vocabulary, 4)
+        phrases = []
+        for template in range(templates):
+            words = rng.sample(COMMON_WORDS, rng.randint(1, 3))
+            words.extend(rng.sample(own_words, rng.randint(1, 3)))
+            for keyword in rng.sample(list(keywords), min(len(keywords), rng.randint(0, 2))):
+                words.append("{" + keyword + "}")
+            rng.shuffle(words)
+            phrases.append(" ".join(words))
+        result["BenchmarkIntent{}".format(number)] = {
+            'locale': {
+                'en-US': {
+                    'keywords': keywords,
+                    'templates': phrases
+                }
+            },
+            'action': handle
+        }
+    return result
+
+
+# Utterances are templates with their keywords filled in, with a word
+# dropped or an extra word added now and then, like a real transcription.
+def make_utterances(rng, intents, count):
+    names = list(intents)
+    utterances = []
+    for number in range(count):
+        locale = intents[rng.choice(names)]['locale']['en-US']
+        words = []
+        for word in rng.choice(locale['templates']).split():
+            if word.startswith("{"):
+                words.append(rng.choice(locale['keywords'][word[1:-1]]))
+            else:
+                words.append(word)
+        if rng.random() < 0.2 and len(words) > 1:
+            del words[rng.randrange(len(words))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words) + 1), "PLEASE")
+        utterances.append(" ".join(words).lower())
+    return utterances
+
+
+def percentiles(times):
+    times = sorted(times)
+    result = {}
+    for percentile in (50, 95, 99):
+        index = min(len(times) - 1, int(round(percentile / 100 * (len(times) - 1))))
+        result["p{}".format(percentile)] = times[index]
+    result["mean"] = sum(times) / len(times)
+    return result
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+# Measure one configuration. The timings and the memory use are measured
+# in separate passes, since tracing memory allocations slows python down.
+def run(plugin_class, config):
+    rng = random.Random(config['seed'])
+    intents = make_intents(
+        rng,
+        config['intents'],
+        config['templates'],
+        config['keyword_groups'],
+        config['keyword_values']
+    )
+    utterances = make_utterances(rng, intents, config['utterances'])
+    results = {}
+
+    gc.collect()
+    plugin = plugin_class()
+    results['add_intents'], ignore = timed(plugin.add_intents, intents)
+    results['train'], ignore = timed(plugin.train)
+    first, phrases = timed(plugin.get_plugin_phrases)
+    again, ignore = timed(plugin.get_plugin_phrases)
+    results['get_plugin_phrases'] = {
+        'first': first,
+        'again': again,
+        'phrases': len(phrases)
+    }
+    times = []
+    for utterance in utterances:
+        seconds, ignore = timed(plugin.determine_intent, utterance)
+        times.append(seconds)
+    results['determine_intent'] = percentiles(times)
+    del plugin
+
+    memory = {}
+    gc.collect()
+    tracemalloc.start()
+    plugin = plugin_class()
+    plugin.add_intents(intents)
+    plugin.train()
+    memory['train'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    plugin.get_plugin_phrases()
+    memory['get_plugin_phrases'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    for utterance in utterances:
+        plugin.determine_intent(utterance)
+    memory['determine_intent'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results['peak_memory_bytes'] = memory
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Flatten the results into {"intents=10 train": seconds, ...} so two runs
+# can be lined up against each other
+def flatten(report):
+    values = {}
+    for run_result in report['runs']:
+        label = "intents={}".format(run_result['config']['intents'])
+
+        def walk(prefix, value):
+            if isinstance(value, dict):
+                for key in value:
+                    walk("{} {}".format(prefix, key), value[key])
+            elif isinstance(value, (int, float)):
+                values[prefix] = value
+        walk(label, run_result['results'])
+    return values
+
+
+def compare(before, after):
+    before = flatten(before)
+    after = flatten(after)
+    for key in sorted(after):
+        if key in before and before[key]:
+            change = (after[key] - before[key]) / before[key] * 100
+            print("{:<55} {:>14.6g} {:>14.6g} {:>+8.1f}%".format(
+                key, before[key], after[key], change
+            ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Naomi2 TTI plugin"
+    )
+    parser.add_argument('--intents', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--templates', type=int, default=5)
+    parser.add_argument('--keyword-groups', type=int, default=1)
+    parser.add_argument('--keyword-values', type=int, default=20)
+    parser.add_argument('--utterances', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--setting',
+        action='append',
+        default=[],
+        metavar='NAME=VALUE',
+        help="a naomi2_tti profile setting, like scoring=numpy"
+    )
+    parser.add_argument('--output', help="save the results to this file")
+    parser.add_argument('--compare', help="compare with an earlier results file")
+    args = parser.parse_args(argv)
+
+    # The cache would hide the cost of determine_intent() for repeated
+    # utterances, and the snapshot the cost of training.
+    plugin_settings = {'cache_size': 0, 'snapshot': False}
+    for setting in args.setting:
+        name, value = setting.split("=", 1)
+        try:
+            plugin_settings[name] = json.loads(value)
+        except ValueError:
+            plugin_settings[name] = value
+    settings = {
+        'language': 'en-US',
+        'keyword': ['NAOMI'],
+        'naomi2_tti': plugin_settings
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        plugin_class = load_plugin(settings, directory)
+        report = {
+            'commit': git_commit(),
+            'python': sys.version,
+            'settings': plugin_settings,
+            'runs': []
+        }
+        for intents in args.intents:
+            config = {
+                'intents': intents,
+                'templates': args.templates,
+                'keyword_groups': args.keyword_groups,
+                'keyword_values': args.keyword_values,
+                'utterances': args.utterances,
+                'seed': args.seed
+            }
+            report['runs'].append({
+                'config': config,
+                'results': run(plugin_class, config)
+            })
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import threading
+import time
+
+
+# A least recently used cache of determine_intent() results.
+# Entries are evicted once there are more than size of them, or once they
+# are older than ttl seconds (if ttl is set). A size of 0 disables the
+# cache. Results are copied going in and coming out, so callers are free
+# to modify the matches they get back. The cache can be shared between
+# threads.
+class IntentCache(object):
+    def __init__(self, size=128, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                created, result = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if self.ttl is not None and time.monotonic() - created > self.ttl:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy_result(result)
+
+    def put(self, key, result):
+        if self.size <= 0:
+            return
+        result = copy_result(result)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Copy a determine_intent() result, giving it its own matches lists. The
+# action is a bound method, so it is shared rather than copied.
+def copy_result(result):
+    return {
+        intent: dict(
+            result[intent],
+            matches={
+                keyword: list(values)
+                for keyword, values in result[intent]['matches'].items()
+            }
+        )
+        for intent in result
+    }
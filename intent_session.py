@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_right
+
+
+# Matches an utterance while it is still being spoken, so a command can be
+# acted on as soon as it is clear which intent it is for:
+#   session = tti.start_session()
+#   for partial in transcripts:
+#       top = session.update(partial)
+#       if top is not None and top['margin'] >= 1:
+#           break
+#   result = session.result()
+#
+# Words are taken one at a time. Each one adds its weight to the score of
+# every template containing it and moves the keyword spotter on, so
+# nothing already worked out is done again. The score of a template for a
+# variant is the sum of the weights of the variant's words that are in
+# the template, so replacing a keyword span with its keyword group changes
+# it by a fixed amount for each template. top() uses that to find the best
+# set of spans to replace for each template that has the keyword group,
+# which gives the same scores determine_intent() would give the words so
+# far, without building any variants.
+class IntentSession(object):
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self.reset()
+
+    def reset(self):
+        self.words = []
+        self._version = self._plugin._model_version
+        # The score of every template that shares a word with the
+        # utterance, as {(intent, template number): score}, and the best
+        # of them for each intent
+        self._scores = {}
+        self._best = {}
+        # The keyword spotter's cursors, and the spans found so far for
+        # each intent, as {intent: [(start, end, keyword)]}
+        self._cursors = []
+        self._spans = {}
+        self._template_tokens = {}
+
+    # Add the next word (or words) of the utterance, and return top()
+    def add(self, text):
+        if self._plugin._pending:
+            self._plugin.train()
+        if self._version != self._plugin._model_version:
+            self._replay(self.words)
+        for word in self._plugin.cleantext(text).split():
+            self._add_word(word)
+        return self.top()
+
+    # Take the whole partial transcript so far. Speech to text engines
+    # often change their minds about the last few words, so only the words
+    # after the part that is the same as last time are added, going back
+    # to the last word that did not change if something else did.
+    def update(self, text):
+        if self._plugin._pending:
+            self._plugin.train()
+        words = self._plugin.cleantext(text).split()
+        same = 0
+        while(
+            same < len(words)
+            and same < len(self.words)
+            and words[same] == self.words[same]
+        ):
+            same += 1
+        if same < len(self.words) or self._version != self._plugin._model_version:
+            self._replay(words[:same])
+        for word in words[same:]:
+            self._add_word(word)
+        return self.top()
+
+    # The intent the utterance is most likely for so far, as
+    #   {
+    #       'intent': the name of the intent,
+    #       'input': the words so far,
+    #       'score': the intent's best score,
+    #       'margin': how far ahead of the runner up it is
+    #   }
+    # or None if nothing matches yet.
+    def top(self):
+        scores = self.scores()
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        if not ranked:
+            return None
+        runner_up = scores[ranked[1]] if len(ranked) > 1 else 0
+        return {
+            'intent': self._plugin.intent_map['intents'][ranked[0]]['name'],
+            'input': " ".join(self.words),
+            'score': scores[ranked[0]],
+            'margin': scores[ranked[0]] - runner_up
+        }
+
+    # The best score of every intent that matches the words so far, as
+    # {intent: score}
+    def scores(self):
+        scores = dict(self._best)
+        for intent in self._spans:
+            self._keyword_scores(self._spans[intent], scores)
+        return scores
+
+    # The full determine_intent() result for the words so far
+    def result(self):
+        return self._plugin.determine_intent(" ".join(self.words))
+
+    # A new session with the same words so far, which can go on
+    # separately from this one
+    def copy(self):
+        session = IntentSession.__new__(IntentSession)
+        session._plugin = self._plugin
+        session.words = list(self.words)
+        session._version = self._version
+        session._scores = dict(self._scores)
+        session._best = dict(self._best)
+        session._cursors = list(self._cursors)
+        session._spans = {
+            intent: list(spans) for intent, spans in self._spans.items()
+        }
+        # Only ever added to, and the same for every session
+        session._template_tokens = self._template_tokens
+        return session
+
+    def _replay(self, words):
+        self.reset()
+        for word in words:
+            self._add_word(word)
+
+    def _add_word(self, word):
+        plugin = self._plugin
+        position = len(self.words)
+        self.words.append(word)
+        token = plugin._tokens.get(word)
+        if token in plugin._weights:
+            weight = plugin._weights[token]
+            for template in plugin._index.get(token, ()):
+                try:
+                    self._scores[template] += weight
+                except KeyError:
+                    self._scores[template] = weight
+                if self._scores[template] > self._best.get(template[0], 0):
+                    self._best[template[0]] = self._scores[template]
+        spans = []
+        self._cursors = plugin._spotter.step(
+            self._cursors,
+            position,
+            word,
+            spans
+        )
+        for start, end, intent, keyword in spans:
+            try:
+                self._spans[intent].append((start, end, keyword))
+            except KeyError:
+                self._spans[intent] = [(start, end, keyword)]
+
+    def _keyword_scores(self, spans, scores):
+        # Raise the scores of the intents with templates that do better
+        # when some of this intent's spans are replaced by their keyword
+        # groups. Spans are found in order of their end, so for each
+        # template the best set of spans that do not overlap is a weighted
+        # interval scheduling problem.
+        plugin = self._plugin
+        keywords = [
+            plugin._tokens.get("{" + keyword + "}")
+            for start, end, keyword in spans
+        ]
+        ends = [end for start, end, keyword in spans]
+        templates = {}
+        for keyword in keywords:
+            for template in plugin._index.get(keyword, ()):
+                templates[template] = True
+        for template in templates:
+            tokens = self._tokens_of(template)
+            best = [0] * (len(spans) + 1)
+            for number, (start, end, keyword) in enumerate(spans):
+                gain = 0
+                if keywords[number] in tokens:
+                    gain = plugin._weights.get(keywords[number], 0)
+                for word in self.words[start:end]:
+                    token = plugin._tokens.get(word)
+                    if token in tokens:
+                        gain -= plugin._weights.get(token, 0)
+                before = bisect_right(ends, start, 0, number)
+                best[number + 1] = max(best[number], best[before] + gain)
+            score = self._scores.get(template, 0) + best[-1]
+            if score > scores.get(template[0], 0):
+                scores[template[0]] = score
+
+    def _tokens_of(self, template):
+        try:
+            return self._template_tokens[template]
+        except KeyError:
+            intent, number = template
+            tokens = set(self._plugin._templates[intent][number])
+            self._template_tokens[template] = tokens
+            return tokens
+
+
+# Score several utterances, each a list of words, against every intent at
+# once, as they would be by IntentSession.scores(). Utterances like the
+# hypotheses of a speech to text engine tend to start with the same words,
+# so they are walked as a tree of words, each shared beginning only being
+# scored once. Returns a list of {intent: score}, one for each utterance.
+def score_utterances(plugin, utterances):
+    results = [None] * len(utterances)
+    branches = [(
+        IntentSession(plugin),
+        0,
+        [(number, words) for number, words in enumerate(utterances)]
+    )]
+    while branches:
+        session, depth, group = branches.pop()
+        following = {}
+        for number, words in group:
+            if len(words) == depth:
+                results[number] = session.scores()
+            else:
+                try:
+                    following[words[depth]].append((number, words))
+                except KeyError:
+                    following[words[depth]] = [(number, words)]
+        # The last branch can carry on with this session, the others get
+        # copies of it
+        for count, word in enumerate(following):
+            if count < len(following) - 1:
+                branch = session.copy()
+            else:
+                branch = session
+            branch._add_word(word)
+            branches.append((branch, depth + 1, following[word]))
+    return results
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+# The stages of determine_intent() that are timed
+STAGES = ('clean', 'variants', 'scoring', 'alignment')
+# What is counted for each call
+COUNTERS = ('variants', 'templates_scored', 'alignments')
+
+_logger = logging.getLogger(__name__)
+
+
+# Collects timings and counts from determine_intent() calls.
+#
+# Every call gets a record:
+#   {
+#       'phrase': the cleaned utterance,
+#       'cached': True if the result came from the cache,
+#       'seconds': {stage: wall time spent in that stage},
+#       'counts': {counter: count}
+#   }
+# which is added to the running totals and then passed to each hook, so
+# the stats can be exported somewhere else as they come in.
+class IntentStats(object):
+    def __init__(self):
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.counts = {counter: 0 for counter in COUNTERS}
+        self.last = None
+
+    def start(self):
+        return {
+            'phrase': None,
+            'cached': False,
+            'seconds': {stage: 0.0 for stage in STAGES},
+            'counts': {counter: 0 for counter in COUNTERS}
+        }
+
+    def finish(self, record):
+        self.calls += 1
+        if record['cached']:
+            self.cache_hits += 1
+        for stage in STAGES:
+            self.seconds[stage] += record['seconds'][stage]
+        for counter in COUNTERS:
+            self.counts[counter] += record['counts'][counter]
+        self.last = record
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                _logger.warning(f"Stats hook {hook} failed: {e}")
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'cache_hits': self.cache_hits,
+            'seconds': dict(self.seconds),
+            'counts': dict(self.counts),
+            'last': self.last
+        }
+
+
+# Add the time since started to a stage of the record, and return the
+# current time so the next stage can start from it
+def lap(record, stage, started):
+    now = time.perf_counter()
+    record['seconds'][stage] += now - started
+    return now
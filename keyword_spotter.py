@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+import hashlib
+import sys
+
+
+# The keyword spotter keeps the values of every keyword group and finds
+# every occurrence of every keyword value in an utterance in a single left
+# to right pass over its words.
+#
+# The values of a keyword group are kept once as a sorted tuple with the
+# duplicates removed, shared by every keyword group (of any intent) with
+# the same values, so a big list like a music library that several
+# intents use is only held in memory once. Each list of values is known
+# by a digest of its contents:
+#   {
+#       digest: {
+#           'values': ("HAPPY", "I'M SO EXCITED"),
+#           'users': {('MPDIntent', 'Playlist'): True}
+#       }
+#   }
+# Keyword values are found with a trie keyed by word, so multi-word values
+# like "I'M SO EXCITED" are supported. Each node that ends a keyword value
+# records which lists of values it belongs to, as a tuple of digests, and
+# a node that no longer value carries on from is just that tuple:
+#   {
+#       'I\'M': {
+#           None: (digest,),
+#           'SO': {
+#               'EXCITED': (digest,)
+#           }
+#       }
+#   }
+# Most values are a word or two long, so most nodes are those tuples.
+# Words and values are interned, so a word that starts or ends many values
+# is only held once.
+# While scanning, we keep a cursor for every partial match that is still
+# alive, so each word of the utterance is only looked at once per cursor
+# and the cost does not depend on how many keyword values there are.
+#
+# Lists with more than limit values are left out of the trie, which would
+# take several times the memory of the values themselves. Their values
+# are found by binary search in the sorted tuple instead: a cursor keeps
+# the words matched so far, and lives while some value starts with them.
+class KeywordSpotter(object):
+    def __init__(self, limit=5000):
+        self.limit = limit
+        self._root = {}
+        self._groups = {}
+        # The digests of the lists that are searched instead of being in
+        # the trie
+        self._large = {}
+
+    # The spotter is made of built in types only, so it can be saved with
+    # the rest of the trained model and loaded again with load()
+    def dump(self):
+        return {
+            'root': self._root,
+            'groups': self._groups,
+            'large': self._large
+        }
+
+    @classmethod
+    def load(cls, model, limit=5000):
+        spotter = cls(limit)
+        spotter._root = model['root']
+        spotter._groups = model['groups']
+        spotter._large = model['large']
+        return spotter
+
+    # Add a keyword group of an intent, and return its values as a sorted
+    # tuple, which is the same tuple for every group with these values
+    def add(self, intent, keyword, values):
+        values = _normalize(values)
+        digest = _digest(values)
+        try:
+            group = self._groups[digest]
+        except KeyError:
+            group = {'values': values, 'users': {}}
+            self._groups[digest] = group
+            if len(values) > self.limit:
+                self._large[digest] = True
+            else:
+                # Every value only in this list ends with the same tuple
+                ends = (digest,)
+                for value in values:
+                    self._add_value(digest, value, ends)
+        group['users'][(intent, keyword)] = True
+        return group['values']
+
+    # Remove a keyword group of an intent, forgetting the values once no
+    # group uses them
+    def remove(self, intent, keyword, values):
+        digest = _digest(_normalize(values))
+        try:
+            group = self._groups[digest]
+        except KeyError:
+            return
+        group['users'].pop((intent, keyword), None)
+        if group['users']:
+            return
+        del self._groups[digest]
+        if self._large.pop(digest, None) is None:
+            for value in group['values']:
+                self._remove_value(digest, value)
+
+    def _add_value(self, digest, value, ends):
+        words = [sys.intern(word) for word in value.split()]
+        if not words:
+            return
+        node = self._root
+        for word in words[:-1]:
+            child = node.get(word)
+            if child is None:
+                child = {}
+                node[word] = child
+            elif isinstance(child, tuple):
+                child = {None: child}
+                node[word] = child
+            node = child
+        child = node.get(words[-1])
+        if child is None:
+            node[words[-1]] = ends
+        elif isinstance(child, tuple):
+            if digest not in child:
+                node[words[-1]] = child + (digest,)
+        elif digest not in child.get(None, ()):
+            child[None] = child.get(None, ()) + (digest,)
+
+    def _remove_value(self, digest, value):
+        words = value.split()
+        if not words:
+            return
+        path = [self._root]
+        for word in words[:-1]:
+            child = path[-1].get(word)
+            if not isinstance(child, dict):
+                return
+            path.append(child)
+        node = path[-1]
+        child = node.get(words[-1])
+        if isinstance(child, tuple):
+            ends = child
+        elif child is None:
+            return
+        else:
+            ends = child.get(None, ())
+        if digest not in ends:
+            return
+        ends = tuple(other for other in ends if other != digest)
+        if isinstance(child, tuple):
+            if ends:
+                node[words[-1]] = ends
+            else:
+                del node[words[-1]]
+        elif ends:
+            child[None] = ends
+        else:
+            del child[None]
+        # Prune the nodes that no longer lead to any keyword value, and
+        # turn the ones that only end values back into tuples
+        for depth in reversed(range(1, len(path))):
+            node = path[depth]
+            if not node:
+                del path[depth - 1][words[depth - 1]]
+            elif len(node) == 1 and None in node:
+                path[depth - 1][words[depth - 1]] = node[None]
+            else:
+                break
+
+    # Returns a list of (start, end, intent, keyword) tuples, one for each
+    # keyword group a span of words matches, where words[start:end] is the
+    # matched keyword value. The list is ordered by start, then end.
+    def find(self, words):
+        spans = []
+        cursors = []
+        for position, word in enumerate(words):
+            cursors = self.step(cursors, position, word, spans)
+        spans.sort(key=lambda span: (span[0], span[1]))
+        return spans
+
+    # Move on to the word at position, which can be the next word of an
+    # utterance that is still coming in. The cursors are the
+    # (start, node) of every keyword value still being matched in the
+    # trie, or (start, digest, words so far) for the big lists, starting
+    # with an empty list. The spans of any values ending at this word are
+    # added to spans, and the cursors for the next word are returned.
+    def step(self, cursors, position, word, spans):
+        alive = []
+        starting = [(position, self._root)]
+        for digest in self._large:
+            starting.append((position, digest, ""))
+        for cursor in cursors + starting:
+            if len(cursor) == 2:
+                start, node = cursor
+                try:
+                    node = node[word]
+                except KeyError:
+                    continue
+                if isinstance(node, tuple):
+                    digests = node
+                else:
+                    alive.append((start, node))
+                    digests = node.get(None, ())
+            else:
+                start, digest, prefix = cursor
+                values = self._groups[digest]['values']
+                prefix = prefix + " " + word if prefix else word
+                number = bisect_left(values, prefix)
+                if number == len(values) or not values[number].startswith(prefix):
+                    continue
+                digests = ()
+                if values[number] == prefix:
+                    digests = (digest,)
+                    number += 1
+                # Carry on if a longer value starts with these words. They
+                # sort straight after the value that is just these words.
+                if(
+                    number < len(values)
+                    and values[number].startswith(prefix + " ")
+                ):
+                    alive.append((start, digest, prefix))
+            for digest in digests:
+                for intent, keyword in self._groups[digest]['users']:
+                    spans.append((start, position + 1, intent, keyword))
+        return alive
+
+
+# The values, one space between words, sorted without any duplicates
+def _normalize(values):
+    return tuple(sorted(set(
+        sys.intern(" ".join(value.split())) for value in values
+    )))
+
+
+def _digest(values):
+    return hashlib.sha256("\n".join(values).encode("utf-8")).hexdigest()
@@ -1,11 +1,30 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import bisect
+from collections import OrderedDict
+import concurrent.futures
+import copy
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
 import os
-import re
-from jiwer import wer
+import threading
+import time
 from naomi import paths
 from naomi import plugin
 from naomi import profile
+from .alignment import Aligner
+from .intent_cache import IntentCache
+from .intent_session import IntentSession
+from .intent_session import score_utterances
+from . import intent_stats
+from .keyword_spotter import KeywordSpotter
+from . import numpy_scorer
+from . import snapshot
+from .tokens import TokenTable
 import pdb
 from pprint import pprint
 import random
@@ -18,9 +37,145 @@ def to_keyword(word):
     return "{}{}{}".format("{", word, "}")
 
 
+# Find the locale to use from the ones an intent supports. If the locale
+# is not available, try matching just the language ("en-US" -> "en").
+# Returns None if the intent does not support the language at all.
+def match_locale(locales, locale):
+    if(locale in locales):
+        return locale
+    for language in locales:
+        if(language[:2] == locale[:2]):
+            return language
+    return None
+
+
+# The attributes that make up the model for a single locale, which are
+# put aside and brought back when switching between locales
+MODEL_ATTRIBUTES = (
+    'intent_map',
+    'keywords',
+    'words',
+    'trained',
+    '_word_intents',
+    '_tokens',
+    '_templates',
+    '_index',
+    '_weights',
+    '_spotter',
+    '_pending',
+    '_cache',
+    '_numpy_scorer',
+    '_template_phrases_cache'
+)
+
+
+# The plugin determine_intents() is working for, in one of its worker
+# processes. Each worker is forked with the plugin and sets this when it
+# starts, so the trained model is inherited rather than sent over.
+_batch_plugin = None
+
+
+def _batch_start(plugin):
+    global _batch_plugin
+    _batch_plugin = plugin
+
+
+def _batch_determine_intent(job):
+    return _batch_plugin._batch_item(*job)
+
+
 class Naomi2TTIPlugin(plugin.TTIPlugin):
     def __init__(self, *args, **kwargs):
         self._logger = logging.getLogger(__name__)
+        self.intent_map = {'intents': {}}
+        self.keywords = {}
+        self.words = {}
+        self.trained = False
+        # The intents each word appears in, as {word: {intent: True}}.
+        # train() keeps the number of intents for each word in self.words.
+        self._word_intents = {}
+        # Every word of every template is interned as a token, and each
+        # template is also kept as an array of tokens, as
+        # {intent: [array('I')]}, in the same order as its templates.
+        self._tokens = TokenTable()
+        self._templates = {}
+        # Compiled by train(). _index maps each token to the templates it
+        # appears in, as {(intent, template number): True}, and _weights
+        # maps each token to 1/(number of intents its word appears in).
+        self._index = {}
+        self._weights = {}
+        # Goes up every time the model changes, so anything worked out
+        # from the old model (like an IntentSession) knows to start again
+        self._model_version = 0
+        # Keeps the keyword values and finds them in an utterance, filled
+        # in by add_intents(). Lists of more than keyword_trie_limit values
+        # are searched rather than added to its trie, to save memory.
+        self._keyword_trie_limit = profile.get(
+            ['naomi2_tti', 'keyword_trie_limit'],
+            5000
+        )
+        self._spotter = KeywordSpotter(self._keyword_trie_limit)
+        # Matches utterances up with templates to find slot values. Each
+        # thread gets its own, since an aligner reuses its buffers.
+        self._local = threading.local()
+        # Intents passed to add_intents() that have not been compiled yet,
+        # as (intent, intent_base, locale_data), the action for every
+        # intent by name, and every intent as (intent_base, locales), so
+        # the model can be compiled again for another locale.
+        self._pending = []
+        self._actions = {}
+        self._registered = {}
+        # The locale the model is for, and copies of the plugin with the
+        # models for other locales, least recently used first. Up to
+        # max_locales models are kept, including the one in use.
+        self._locale = profile.get("language")
+        self._models = OrderedDict()
+        self._models_lock = threading.Lock()
+        self._max_locales = profile.get(['naomi2_tti', 'max_locales'], 2)
+        # Where to keep snapshots of the trained models (one for each
+        # locale), or None to always train from scratch
+        self._snapshot_file = None
+        if profile.get(['naomi2_tti', 'snapshot'], True):
+            self._snapshot_file = paths.data("naomi2_tti", "model.pickle")
+        # The most variants of an utterance determine_intent() will score
+        self._max_variants = profile.get(['naomi2_tti', 'max_variants'], 1000)
+        # Recent determine_intent() results, cleared whenever the model
+        # changes
+        self._cache = IntentCache(
+            profile.get(['naomi2_tti', 'cache_size'], 128),
+            profile.get(['naomi2_tti', 'cache_ttl'])
+        )
+        # Score variants with plain python, or in batches with NumPy, which
+        # is faster for large numbers of intents. The NumPy scorer is built
+        # from the trained model when it is first needed.
+        self._scoring = profile.get(['naomi2_tti', 'scoring'], 'python')
+        if self._scoring == 'numpy' and numpy_scorer.np is None:
+            self._logger.warning(
+                "NumPy is not installed, using python scoring instead"
+            )
+            self._scoring = 'python'
+        self._numpy_scorer = None
+        # Timings and counts for determine_intent(), if they are turned on
+        # with enable_stats() or the stats setting, and a running count of
+        # the template scores worked out
+        self._stats = None
+        if profile.get(['naomi2_tti', 'stats'], False):
+            self.enable_stats()
+        self._templates_scored = 0
+        # The worker threads for determine_intent_async(), and the event
+        # used to stop the call currently running when a new one comes in
+        self._executor = None
+        self._async_lock = threading.Lock()
+        self._async_current = None
+        # The phrases get_plugin_phrases() returns for the templates, with
+        # the keywords expanded, up to max_phrase_expansions per template,
+        # and the standard phrases file as ((file name, mtime), phrases)
+        self._max_phrase_expansions = profile.get(
+            ['naomi2_tti', 'max_phrase_expansions'],
+            10000
+        )
+        self._template_phrases_cache = None
+        self._standard_phrases_cache = (None, [])
 
     # self
     #   .intent_map
@@ -30,61 +185,262 @@ class Naomi2TTIPlugin(plugin.TTIPlugin):
     #   .words
     #       [word]
     def add_intents(self, intents):
+        # Compiling the intents is put off until train(), which can skip
+        # it entirely if there is a snapshot of a model trained on exactly
+        # the same intents.
+        self._model_changed()
+        # The models for other locales are compiled again when needed
+        with self._models_lock:
+            self._models.clear()
         for intent in intents:
             # this prevents collisions between intents by different authors
             intent_base = intent
             intent_inc = 0
-            locale = profile.get("language")
-            while intent in self.intent_map['intents']:
+            while intent in self._actions:
                 intent_inc += 1
                 intent = "{}{}".format(intent_base, intent_inc)
-            if('locale' in intents[intent_base]):
-                # If the selected locale is not available, try matching just
-                # the language ("en-US" -> "en")
-                if(locale not in intents[intent_base]['locale']):
-                    for language in intents[intent_base]['locale']:
-                        if(language[:2] == locale[:2]):
-                            locale = language
-                            break
-            if(locale not in intents[intent_base]['locale']):
-                raise KeyError("Language not supported")
-            if('keywords' in intents[intent_base]['locale'][locale]):
-                if intent not in self.keywords:
-                    self.keywords[intent] = {}
-                for keyword in intents[intent_base]['locale'][locale]['keywords']:
-                    if keyword not in self.keywords[intent]:
-                        self.keywords[intent][keyword] = []
-                    self.keywords[intent][keyword].extend([word.upper() for word in intents[intent_base]['locale'][locale]['keywords'][keyword]])
-            self.intent_map['intents'][intent] = {
-                'action': intents[intent_base]['action'],
-                'name': intent_base,
-                'templates': [],
-                'words': {}
-            }
-            for phrase in intents[intent_base]['locale'][locale]['templates']:
-                # Save the phrase so we can search for undefined keywords
-                # Convert the template to upper case and expand contractions
-                clean_phrase = self.cleantext(phrase)
-                # At this point, I want to make a list of variations for each
-                # possible contraction.
-                contraction_phrases = self.getcontractions(clean_phrase)
-                #pdb.set_trace()
-                self.intent_map['intents'][intent]['templates'].append(clean_phrase)
-                for word in phrase.split():
-                    if not self.is_keyword(word):
-                        word = word.upper()
-                    try:
-                        self.intent_map['intents'][intent]['words'][word] += 1
-                    except KeyError:
-                        self.intent_map['intents'][intent]['words'][word] = 1
-                        self._logger.info(f"Adding '{word}' to '{intent}'")
-                    # keep a list of the intents a word appears in
-                    try:
-                        self.words[word].update({intent: True})
-                    except KeyError:
-                        self.words[word] = {intent: True}
+            self._actions[intent] = intents[intent_base]['action']
+            self._registered[intent] = (
+                intent_base,
+                intents[intent_base]['locale']
+            )
+            # An intent that doesn't support the locale in use is still
+            # registered, for the models of the locales it does support
+            locale = match_locale(intents[intent_base]['locale'], self._locale)
+            if(locale is None):
+                self._logger.info(f"{intent} does not support {self._locale}")
+            elif self.trained:
+                # A plugin loaded after startup only updates the parts of
+                # the model that involve its own intents.
+                self._compile_intent(
+                    intent,
+                    intent_base,
+                    intents[intent_base]['locale'][locale]
+                )
+                self._train_intent(intent)
+            else:
+                self._pending.append(
+                    (intent, intent_base, intents[intent_base]['locale'][locale])
+                )
+
+    def remove_intents(self, intents):
+        # Takes the names of intents as they were registered (which may
+        # have a number added to avoid a collision) and removes them from
+        # the model, again only touching the parts involving those intents.
+        self._model_changed()
+        with self._models_lock:
+            self._models.clear()
+        for intent in intents:
+            if intent not in self._actions:
+                raise KeyError(f"No such intent: {intent}")
+            del self._registered[intent]
+            self._pending = [
+                pending for pending in self._pending if pending[0] != intent
+            ]
+            if intent in self.intent_map['intents']:
+                self._forget_intent(intent)
+            del self._actions[intent]
+
+    def _compile_intent(self, intent, intent_base, locale_data):
+        if('keywords' in locale_data):
+            if intent not in self.keywords:
+                self.keywords[intent] = {}
+            for keyword in locale_data['keywords']:
+                # The spotter keeps a single copy of each list of values,
+                # which every keyword group with the same values shares
+                self.keywords[intent][keyword] = self._spotter.add(
+                    intent,
+                    keyword,
+                    [word.upper() for word in locale_data['keywords'][keyword]]
+                )
+                self._tokens.add(to_keyword(keyword))
+        self.intent_map['intents'][intent] = {
+            'action': self._actions[intent],
+            'name': intent_base,
+            'templates': [],
+            'words': {}
+        }
+        self._templates[intent] = []
+        for phrase in locale_data['templates']:
+            # Save the phrase so we can search for undefined keywords
+            # Convert the template to upper case and expand contractions
+            clean_phrase = self.cleantext(phrase)
+            # At this point, I want to make a list of variations for each
+            # possible contraction.
+            contraction_phrases = self.getcontractions(clean_phrase)
+            #pdb.set_trace()
+            self.intent_map['intents'][intent]['templates'].append(clean_phrase)
+            self._templates[intent].append(
+                self._tokens.encode(clean_phrase.split())
+            )
+            for word in phrase.split():
+                if not self.is_keyword(word):
+                    word = word.upper()
+                try:
+                    self.intent_map['intents'][intent]['words'][word] += 1
+                except KeyError:
+                    self.intent_map['intents'][intent]['words'][word] = 1
+                    self._logger.info(f"Adding '{word}' to '{intent}'")
+                # keep a list of the intents a word appears in
+                try:
+                    self._word_intents[word].update({intent: True})
+                except KeyError:
+                    self._word_intents[word] = {intent: True}
+
+    def _forget_intent(self, intent):
+        for word in self.intent_map['intents'][intent]['words']:
+            token = self._tokens.get(word)
+            del self._word_intents[word][intent]
+            if self._word_intents[word]:
+                self.words[word] = len(self._word_intents[word])
+                self._weights[token] = 1 / self.words[word]
+            else:
+                del self._word_intents[word]
+                del self.words[word]
+                del self._weights[token]
+        for number, template in enumerate(self._templates[intent]):
+            for token in set(template):
+                del self._index[token][(intent, number)]
+                if not self._index[token]:
+                    del self._index[token]
+        del self._templates[intent]
+        if intent in self.keywords:
+            for keyword in self.keywords[intent]:
+                self._spotter.remove(
+                    intent,
+                    keyword,
+                    self.keywords[intent][keyword]
+                )
+            del self.keywords[intent]
+        del self.intent_map['intents'][intent]
 
     def train(self):
+        self._model_changed()
+        filename = self._snapshot_path()
+        if self._pending and filename:
+            key = self._intents_key()
+            model = snapshot.load(filename, key)
+            if model is not None:
+                self._logger.info(
+                    f"Loaded trained model from {filename}"
+                )
+                self._load_model(model)
+                self._pending = []
+                self.trained = True
+                return
+        compiled = bool(self._pending)
+        for intent, intent_base, locale_data in self._pending:
+            self._compile_intent(intent, intent_base, locale_data)
+        self._pending = []
+        self._train()
+        if compiled and filename:
+            snapshot.save(filename, self._intents_key(), self._dump_model())
+
+    def _snapshot_path(self):
+        # model.pickle -> model.en-US.pickle
+        if self._snapshot_file is None:
+            return None
+        root, extension = os.path.splitext(self._snapshot_file)
+        return f"{root}.{self._locale}{extension}"
+
+    def _intents_key(self):
+        # A hash of the intents the model for the locale is compiled from,
+        # which identifies a snapshot of the trained model
+        intents_hash = hashlib.sha256()
+        for intent in self._registered:
+            intent_base, locales = self._registered[intent]
+            locale = match_locale(locales, self._locale)
+            if locale is not None:
+                intents_hash.update(
+                    json.dumps(
+                        [intent, intent_base, locale, locales[locale]],
+                        sort_keys=True,
+                        default=str
+                    ).encode("utf-8")
+                )
+        return intents_hash.hexdigest()
+
+    def set_locale(self, locale):
+        # Switch to the model for another locale. The model in use is put
+        # aside, so switching back to it later is instant. A model that
+        # has not been built yet, or was dropped to keep to max_locales,
+        # is compiled from the registered intents when it is first used
+        # (or loaded from its snapshot). Intents that don't support the
+        # locale are left out of its model.
+        # The model is swapped out from under any determine_intent_async()
+        # call that is still running, so wait for those to finish first.
+        if locale == self._locale:
+            return
+        with self._models_lock:
+            try:
+                model = self._models.pop(locale)
+            except KeyError:
+                model = None
+            self._models[self._locale] = copy.copy(self)
+            if model is None:
+                for name, value in self._new_model(locale).items():
+                    setattr(self, name, value)
+            else:
+                for name in MODEL_ATTRIBUTES:
+                    setattr(self, name, getattr(model, name))
+            self._locale = locale
+            self._model_version += 1
+            self._drop_models()
+
+    def _for_locale(self, locale):
+        # The plugin to determine intents in a locale with, without
+        # switching this one over to it, so calls for different locales
+        # can run at the same time. The model for another locale is kept
+        # in a copy of the plugin, which shares everything else with it.
+        if locale is None or locale == self._locale:
+            return self
+        with self._models_lock:
+            try:
+                model = self._models.pop(locale)
+            except KeyError:
+                model = copy.copy(self)
+                for name, value in self._new_model(locale).items():
+                    setattr(model, name, value)
+                model._locale = locale
+            if model._pending:
+                model.train()
+            self._models[locale] = model
+            self._drop_models()
+        return model
+
+    def _drop_models(self):
+        # Only called with _models_lock held
+        while self._models and len(self._models) >= self._max_locales:
+            dropped, model = self._models.popitem(last=False)
+            self._logger.info(f"Dropping the model for {dropped}")
+
+    def _new_model(self, locale):
+        pending = []
+        for intent in self._registered:
+            intent_base, locales = self._registered[intent]
+            matched = match_locale(locales, locale)
+            if matched is None:
+                self._logger.info(f"{intent} does not support {locale}")
+            else:
+                pending.append((intent, intent_base, locales[matched]))
+        return {
+            'intent_map': {'intents': {}},
+            'keywords': {},
+            'words': {},
+            'trained': False,
+            '_word_intents': {},
+            '_tokens': TokenTable(),
+            '_templates': {},
+            '_index': {},
+            '_weights': {},
+            '_spotter': KeywordSpotter(self._keyword_trie_limit),
+            '_pending': pending,
+            '_cache': IntentCache(self._cache.size, self._cache.ttl),
+            '_numpy_scorer': None,
+            '_template_phrases_cache': None
+        }
+
+    def _train(self):
         # Here we want to go through a list of all the words in all the intents
         # and get a count of the number of intents the word appears in, then
         # divide the weight of every instance by the total number of times it
@@ -97,12 +453,353 @@ class Naomi2TTIPlugin(plugin.TTIPlugin):
                     wordcounts[word] += 1
                 else:
                     wordcounts[word] = 1
+        self.words = {}
         for word in wordcounts:
             # set a count for each word
             self.words[word] = wordcounts[word]
+        self._weights = {
+            self._tokens.add(word): 1 / count
+            for word, count in self.words.items()
+        }
+        # Build an inverted index from each token to the templates that
+        # contain it, so scoring a variant only has to visit the templates
+        # that share at least one word with it.
+        self._index = {}
+        for intent in self.intent_map['intents']:
+            for number, template in enumerate(self._templates[intent]):
+                for token in set(template):
+                    try:
+                        self._index[token][(intent, number)] = True
+                    except KeyError:
+                        self._index[token] = {(intent, number): True}
         self.trained = True
 
+    def _train_intent(self, intent):
+        # Update the counts, weights and index for a single newly compiled
+        # intent. The result is the same as running _train() again.
+        for word in self.intent_map['intents'][intent]['words']:
+            self.words[word] = len(self._word_intents[word])
+            self._weights[self._tokens.add(word)] = 1 / self.words[word]
+        for number, template in enumerate(self._templates[intent]):
+            for token in set(template):
+                try:
+                    self._index[token][(intent, number)] = True
+                except KeyError:
+                    self._index[token] = {(intent, number): True}
+
+    def _dump_model(self):
+        # The trained model without the actions, which can't be saved.
+        # They are bound again by intent name when the model is loaded.
+        # Tokens are turned back into words, since they depend on the
+        # order words were first seen in, and are handed out again when
+        # the model is loaded.
+        word = self._tokens.word
+        intent_map = {'intents': {}}
+        for intent in self.intent_map['intents']:
+            intent_map['intents'][intent] = dict(
+                self.intent_map['intents'][intent],
+                action=None
+            )
+        return {
+            'intent_map': intent_map,
+            'keywords': self.keywords,
+            'words': self.words,
+            'word_intents': self._word_intents,
+            'index': {word(token): self._index[token] for token in self._index},
+            'weights': {
+                word(token): weight for token, weight in self._weights.items()
+            },
+            'spotter': self._spotter.dump()
+        }
+
+    def _load_model(self, model):
+        self.intent_map = model['intent_map']
+        for intent in self.intent_map['intents']:
+            self.intent_map['intents'][intent]['action'] = self._actions[intent]
+        self.keywords = model['keywords']
+        self.words = model['words']
+        self._word_intents = model['word_intents']
+        self._templates = {
+            intent: [
+                self._tokens.encode(template.split())
+                for template in self.intent_map['intents'][intent]['templates']
+            ]
+            for intent in self.intent_map['intents']
+        }
+        self._index = {
+            self._tokens.add(word): templates
+            for word, templates in model['index'].items()
+        }
+        self._weights = {
+            self._tokens.add(word): weight
+            for word, weight in model['weights'].items()
+        }
+        for intent in self.keywords:
+            for keyword in self.keywords[intent]:
+                self._tokens.add(to_keyword(keyword))
+        self._spotter = KeywordSpotter.load(
+            model['spotter'],
+            self._keyword_trie_limit
+        )
+
+    def _model_changed(self):
+        # Throw away anything derived from the old model
+        self._model_version += 1
+        self._cache.clear()
+        self._numpy_scorer = None
+        self._template_phrases_cache = None
+
+    def _score_variants(self, variants):
+        # Score a batch of variants, each a tuple of tokens. The python
+        # scorer is lazy, so variants are only scored as they are used.
+        if self._scoring == 'numpy':
+            if self._numpy_scorer is None:
+                self._numpy_scorer = numpy_scorer.NumpyScorer(
+                    self.intent_map,
+                    self._index,
+                    self._weights
+                )
+            self._templates_scored += (
+                len(variants) * self._numpy_scorer.template_count
+            )
+            return iter(self._numpy_scorer.score(variants))
+        return map(self._score_variant, variants)
+
+    def _score_variant(self, tokens):
+        # Return the score of the best matching template for each intent.
+        # A template scores 1/count for every word in the variant that
+        # also appears in the template, so more popular words have less
+        # weight. Scores are accumulated in the order of the variant's
+        # words, exactly as if every template were scored in turn.
+        templatescores = {}
+        for token in tokens:
+            try:
+                weight = self._weights[token]
+            except KeyError:
+                continue
+            for template in self._index.get(token, ()):
+                try:
+                    templatescores[template] += weight
+                except KeyError:
+                    templatescores[template] = weight
+        self._templates_scored += len(templatescores)
+        intentscores = {intent: 0 for intent in self.intent_map['intents']}
+        for (intent, number), score in templatescores.items():
+            if score > intentscores[intent]:
+                intentscores[intent] = score
+        return intentscores
+
+    def _variants(self, words, stop=None):
+        # Generate (bound, variant, matches, spans) for the utterance and
+        # for each intent's combinations of non-overlapping keyword spans,
+        # with each span replaced by the name of its keyword group:
+        #   "PLAY {Playlist}": {'Playlist': ["I'M SO EXCITED"]}
+        # The variant is a tuple of tokens, and spans lists the
+        # (start, stop, keyword) of each span that was replaced, so the
+        # words of the variant can be put back together when needed.
+        # Variants come out in order of decreasing bound, where the bound
+        # is the sum of the weights of all of the variant's words. No
+        # template can score more than that, so once the bound drops to the
+        # best score found so far we can stop without building the rest.
+        # stop() is checked every so often while searching the keyword
+        # spans, and once it returns True no more variants are built.
+        tokens = self._tokens.lookup(words)
+        weights = [self._bound_weight(token) for token in tokens]
+        base = 0
+        for weight in weights:
+            base += weight
+        spans = {}
+        for span in self._spotter.find(words):
+            try:
+                spans[span[2]].append(span)
+            except KeyError:
+                spans[span[2]] = [span]
+        streams = [iter([(base, tokens, {}, ())])]
+        for intent in self.keywords:
+            if intent in spans:
+                streams.append(
+                    self._keyword_variants(
+                        words,
+                        tokens,
+                        weights,
+                        base,
+                        spans[intent],
+                        stop
+                    )
+                )
+        # The same variant can come from more than one intent's keywords
+        seen = set()
+        for item in heapq.merge(*streams, key=lambda item: -item[0]):
+            if item[1] not in seen:
+                seen.add(item[1])
+                yield item
+
+    def _keyword_variants(self, words, tokens, weights, base, spans, stop=None):
+        # Best first search over the spans, deciding for each span in turn
+        # whether to substitute it. A partial decision is prioritized by
+        # its bound plus the most the spans still to be decided could add
+        # to it without overlapping, so complete variants come off the
+        # heap in order of their bounds. That estimate is exact, so one of
+        # the choices for the next span is always as good as the decision
+        # so far. Ties go to the decision that has got furthest, so the
+        # search carries on down to a variant instead of going through
+        # every equally good way of choosing between spans (like two
+        # keyword groups with the same values) a span at a time.
+        # No more than a few pops for each variant the caller could
+        # use are made, however the spans tie.
+        deltas = []
+        keywords = []
+        for start, end, intent, keyword in spans:
+            keywords.append(self._tokens.get(to_keyword(keyword)))
+            delta = self._bound_weight(keywords[-1])
+            for weight in weights[start:end]:
+                delta -= weight
+            deltas.append(delta)
+        # The spans are in order of their starts. after[number] is the
+        # first span that can follow span number without overlapping it,
+        # and best[number] the most spans number on could add to a bound.
+        starts = [span[0] for span in spans]
+        after = [
+            max(number + 1, bisect.bisect_left(starts, spans[number][1]))
+            for number in range(len(spans))
+        ]
+        best = [0] * (len(spans) + 1)
+        for number in reversed(range(len(spans))):
+            best[number] = max(
+                best[number + 1],
+                deltas[number] + best[after[number]]
+            )
+        heap = [(-(base + best[0]), 0, 0, 0, (), base)]
+        pushed = 1
+        pops = (max(self._max_variants, 1) + 1) * (len(spans) + 1) * 2
+        while heap and pops > 0:
+            pops -= 1
+            if stop is not None and pops % 64 == 0 and stop():
+                return
+            priority, depth, order, number, chosen, bound = heapq.heappop(heap)
+            if number == len(spans):
+                # The utterance itself is yielded by _variants()
+                if chosen:
+                    yield self._substitute(
+                        words,
+                        tokens,
+                        spans,
+                        keywords,
+                        chosen,
+                        bound
+                    )
+                continue
+            # Leave the span as it is, or substitute it and go on to the
+            # next span that does not overlap it. A choice that is as good
+            # as the decision so far, give or take rounding, keeps its
+            # priority, so it is taken next.
+            include = bound + deltas[number]
+            for following, chosen_next, bound_next in (
+                (number + 1, chosen, bound),
+                (after[number], chosen + (number,), include)
+            ):
+                estimate = -(bound_next + best[following])
+                if abs(estimate - priority) <= 1e-9:
+                    estimate = priority
+                heapq.heappush(
+                    heap,
+                    (
+                        estimate,
+                        -following,
+                        pushed,
+                        following,
+                        chosen_next,
+                        bound_next
+                    )
+                )
+                pushed += 1
+
+    @staticmethod
+    def _substitute(words, tokens, spans, keywords, chosen, bound):
+        variant = []
+        matches = {}
+        replaced = []
+        position = 0
+        for number in chosen:
+            start, stop, intent, keyword = spans[number]
+            variant.extend(tokens[position:start])
+            variant.append(keywords[number])
+            value = " ".join(words[start:stop])
+            try:
+                matches[keyword].append(value)
+            except KeyError:
+                matches[keyword] = [value]
+            replaced.append((start, stop, keyword))
+            position = stop
+        variant.extend(tokens[position:])
+        return (bound, tuple(variant), matches, tuple(replaced))
+
+    def _widen_spans(self, words, variant, best):
+        # Replace each span of the variant with the longest value of the
+        # same keyword group around it that does not overlap the others,
+        # as long as the intent scores as well with it. Returns the
+        # variant, its matches and its spans.
+        intent = best['intent']
+        found = [span for span in self._spotter.find(words) if span[2] == intent]
+        chosen = [
+            (start, stop, intent, keyword)
+            for start, stop, keyword in best['spans']
+        ]
+        keywords = [self._tokens.get(to_keyword(span[3])) for span in chosen]
+        tokens = self._tokens.lookup(words)
+        result = (variant, best['matches'], best['spans'])
+        for number in range(len(chosen)):
+            start, stop, owner, keyword = chosen[number]
+            low = chosen[number - 1][1] if number > 0 else 0
+            high = len(words)
+            if number + 1 < len(chosen):
+                high = chosen[number + 1][0]
+            candidates = [
+                span for span in found
+                if span[3] == keyword
+                and low <= span[0] <= start
+                and stop <= span[1] <= high
+                and span[1] - span[0] > stop - start
+            ]
+            candidates.sort(key=lambda span: span[0] - span[1])
+            for candidate in candidates:
+                trial = chosen[:number] + [candidate] + chosen[number + 1:]
+                bound, widened, matches, spans = self._substitute(
+                    words,
+                    tokens,
+                    trial,
+                    keywords,
+                    range(len(trial)),
+                    None
+                )
+                if self._score_variant(widened)[intent] >= best['score'] - 1e-9:
+                    chosen = trial
+                    result = (widened, matches, spans)
+                    break
+        return result
+
+    @staticmethod
+    def _variant_words(words, spans):
+        # The words of a variant, from the words of the utterance and the
+        # spans that were replaced by their keyword group
+        variant = []
+        position = 0
+        for start, stop, keyword in spans:
+            variant.extend(words[position:start])
+            variant.append(to_keyword(keyword))
+            position = stop
+        variant.extend(words[position:])
+        return variant
+
+    def _bound_weight(self, token):
+        # The most a word can add to the score of any template
+        if token in self._index:
+            return self._weights.get(token, 0)
+        return 0
+
     def get_plugin_phrases(self, passive_listen=False):
+        if self._pending:
+            self.train()
         phrases = []
         # include the keyword, otherwise
         if(passive_listen):
@@ -110,6 +807,15 @@ class Naomi2TTIPlugin(plugin.TTIPlugin):
             if not (isinstance(keywords, list)):
                 keywords = [keywords]
             phrases.extend([word.upper() for word in keywords])
+        # The standard phrases and the templates only change when the file
+        # or the model does, so both are kept in sorted order and merged.
+        return list(heapq.merge(
+            sorted(phrases),
+            self._standard_phrases(),
+            self._template_phrases()
+        ))
+
+    def _standard_phrases(self):
         # Include any custom phrases (things you say to Naomi
         # that don't match plugin phrases). Otherwise, there is
         # a high probability that something you say will be
@@ -120,35 +826,401 @@ class Naomi2TTIPlugin(plugin.TTIPlugin):
         # and shut down.
         custom_standard_phrases_file = paths.data(
             "standard_phrases",
-            "{}.txt".format(profile.get(['language'], 'en-US'))
+            "{}.txt".format(self._locale)
         )
-        if(os.path.isfile(custom_standard_phrases_file)):
-            with open(custom_standard_phrases_file, mode='r') as f:
-                for line in f:
-                    phrase = line.strip()
-                    if phrase:
-                        phrases.append(phrase.upper())
+        try:
+            modified = os.path.getmtime(custom_standard_phrases_file)
+        except OSError:
+            modified = None
+        key = (custom_standard_phrases_file, modified)
+        if self._standard_phrases_cache[0] != key:
+            phrases = []
+            if(modified is not None):
+                with open(custom_standard_phrases_file, mode='r') as f:
+                    for line in f:
+                        phrase = line.strip()
+                        if phrase:
+                            phrases.append(phrase.upper())
+            self._standard_phrases_cache = (key, sorted(phrases))
+        return self._standard_phrases_cache[1]
 
-        for intent in self.intent_map['intents']:
-            if('templates' in self.intent_map['intents'][intent]):
-                templates = self.intent_map['intents'][intent]['templates']
-                if(intent in self.keywords):
-                    keywords = self.keywords[intent]
-                    for keyword in keywords:
-                        # This will not replace keywords that do not have a list associated with them, like regex and open keywords
-                        # print("Replacing {} with words from {} in templates".format(keyword,keywords[keyword]))
-                        for template in templates:
-                            if(to_keyword(keyword) in template):
-                                templates.extend([template.replace(to_keyword(keyword), word.upper()) for word in keywords[keyword]])
-                            # Now that we have expanded every instance of keyword in templates, delete any template that still contains keyword
-                            templates = [template for template in templates if not to_keyword(keyword) in template]
-                phrases.extend(templates)
-        return sorted(phrases)
-
-    def determine_intent(self, phrase):
+    def _template_phrases(self):
+        # Every template with its keywords expanded, worked out once each
+        # time the model changes
+        if self._template_phrases_cache is None:
+            phrases = []
+            for intent in self.intent_map['intents']:
+                phrases.extend(self._expand_templates(intent))
+            self._template_phrases_cache = sorted(phrases)
+        return self._template_phrases_cache
+
+    def _expand_templates(self, intent):
+        # Generate the intent's templates with each keyword replaced by
+        # each of its values. If a template has more than one keyword, we
+        # generate every combination of their values, up to
+        # max_phrase_expansions phrases per template.
+        # This will not replace keywords that do not have a list associated
+        # with them, like regex and open keywords.
+        keywords = self.keywords.get(intent, {})
+        for template in self.intent_map['intents'][intent]['templates']:
+            present = [
+                keyword for keyword in keywords
+                if to_keyword(keyword) in template
+            ]
+            combinations = 1
+            for keyword in present:
+                combinations *= len(keywords[keyword])
+            if combinations > self._max_phrase_expansions:
+                self._logger.info(
+                    f"Only using {self._max_phrase_expansions} of {combinations} expansions of '{template}'"
+                )
+            expansions = itertools.islice(
+                itertools.product(*[keywords[keyword] for keyword in present]),
+                self._max_phrase_expansions
+            )
+            for values in expansions:
+                phrase = template
+                for keyword, value in zip(present, values):
+                    phrase = phrase.replace(to_keyword(keyword), value.upper())
+                yield phrase
+
+    def determine_intent(self, phrase, locale=None):
+        # The locale can be given to use its model instead, for utterances
+        # from users who speak different languages
+        plugin = self._for_locale(locale)
+        if plugin is not self:
+            return plugin.determine_intent(phrase)
+        if self._pending:
+            self.train()
+        record = None
+        if self._stats is not None:
+            record = self._stats.start()
+            started = time.perf_counter()
+        phrase = self.cleantext(phrase)
+        if record is not None:
+            intent_stats.lap(record, 'clean', started)
+            record['phrase'] = phrase
+        # Utterances like "what time is it" come up over and over, so keep
+        # recent results. Ties between intents are broken at random, so a
+        # cached result repeats whichever intent was chosen the first time.
+        result = self._cache.get(phrase)
+        if result is None:
+            intent, result = self._determine_intent(phrase, record=record)
+            self._cache.put(phrase, result)
+        elif record is not None:
+            record['cached'] = True
+        if record is not None:
+            self._stats.finish(record)
+        return result
+
+    def explain_intent(self, phrase):
+        # Determine the intent of the phrase like determine_intent() does
+        # (without using the cache) and also explain how it was scored.
+        # Returns the result and an explanation of the scores of the winning
+        # intent and the runner up, each on its own best variant:
+        #   {
+        #       'input': "WHAT TIME IS IT",
+        #       'intents': [
+        #           {
+        #               'intent': "TimeIntent",
+        #               'name': "TimeIntent",
+        #               'variant': "WHAT TIME IS IT",
+        #               'score': 2.5,
+        #               'templates': [
+        #                   {
+        #                       'template': "WHAT TIME IS IT",
+        #                       'score': 2.5,
+        #                       'words': [("WHAT", 0.5), ("TIME", 1.0), ...]
+        #                   },
+        #                   ...
+        #               ]
+        #           },
+        #           (the runner up)
+        #       ]
+        #   }
+        if self._pending:
+            self.train()
         phrase = self.cleantext(phrase)
-        score = {}
-        allvariants = {phrase: {}}
+        trace = {}
+        intent, result = self._determine_intent(phrase, trace=trace)
+        ranked = [intent]
+        others = [other for other in trace if other != intent]
+        if others:
+            ranked.append(max(others, key=lambda other: trace[other][0]))
+        explanation = {'input': phrase, 'intents': []}
+        for intent in ranked:
+            score, variant = trace[intent]
+            words = variant.split()
+            templates = []
+            for template in self.intent_map['intents'][intent]['templates']:
+                templates.append(self._explain_template(words, template))
+            explanation['intents'].append({
+                'intent': intent,
+                'name': self.intent_map['intents'][intent]['name'],
+                'variant': variant,
+                'score': score,
+                'templates': templates
+            })
+        return result, explanation
+
+    def _explain_template(self, words, template):
+        # The words of the variant that count towards the template's score,
+        # and how much each one adds, in the order they are added up
+        templatewords = set(template.split())
+        contributions = []
+        score = 0
+        for word in words:
+            token = self._tokens.get(word)
+            if word in templatewords and token in self._weights:
+                contributions.append((word, self._weights[token]))
+                score += self._weights[token]
+        return {'template': template, 'score': score, 'words': contributions}
+
+    def determine_intent_nbest(self, hypotheses):
+        # Determine the intent of a list of speech to text hypotheses,
+        # each either a phrase or a (phrase, weight) pair, like the n-best
+        # list with confidences an STT engine returns. Every intent's
+        # combined score is its best score for each hypothesis, weighted by
+        # the hypothesis' share of the total weight. Returns the intents
+        # ranked by their combined score, and the determine_intent() style
+        # result of the winner on the hypothesis where it scored best:
+        #   {
+        #       'result': {'TimeIntent': {'action', 'input', ...}},
+        #       'ranked': [
+        #           {
+        #               'intent': "TimeIntent",
+        #               'score': 2.1,
+        #               'input': "WHAT TIME IS IT"
+        #           },
+        #           ...
+        #       ]
+        #   }
+        # The hypotheses are scored together, so the words they start with
+        # in common are only scored once, and only the winner is aligned.
+        if self._pending:
+            self.train()
+        phrases = []
+        weights = []
+        for hypothesis in hypotheses:
+            if isinstance(hypothesis, str):
+                hypothesis = (hypothesis, 1)
+            phrases.append(self.cleantext(hypothesis[0]))
+            weights.append(hypothesis[1])
+        if not phrases:
+            raise ValueError("No hypotheses")
+        total = sum(weights)
+        if total <= 0:
+            weights = [1] * len(weights)
+            total = len(weights)
+        combined = {}
+        best = {}
+        scores = score_utterances(self, [phrase.split() for phrase in phrases])
+        for number, intentscores in enumerate(scores):
+            for intent, score in intentscores.items():
+                combined[intent] = (
+                    combined.get(intent, 0) + score * weights[number] / total
+                )
+                if intent not in best or score > scores[best[intent]][intent]:
+                    best[intent] = number
+        ranked = sorted(combined, key=combined.get, reverse=True)
+        if not ranked:
+            # Nothing matched any hypothesis, so fall back on the most
+            # likely one
+            number = weights.index(max(weights))
+            return {
+                'result': self._determine_intent(phrases[number])[1],
+                'ranked': []
+            }
+        intent, result = self._determine_intent(
+            phrases[best[ranked[0]]],
+            only_intent=ranked[0]
+        )
+        return {
+            'result': result,
+            'ranked': [
+                {
+                    'intent': self.intent_map['intents'][intent]['name'],
+                    'score': combined[intent],
+                    'input': phrases[best[intent]]
+                }
+                for intent in ranked
+            ]
+        }
+
+    def start_session(self):
+        # Start matching an utterance that is still coming in, a word or a
+        # partial transcript at a time. See IntentSession.
+        if self._pending:
+            self.train()
+        return IntentSession(self)
+
+    async def determine_intent_async(
+        self,
+        phrase,
+        deadline=None,
+        supersede=True,
+        locale=None
+    ):
+        # Determine the intent of the phrase in a worker thread, so a slow
+        # utterance does not block the event loop.
+        # deadline is a time.monotonic() (or loop.time()) value. Once it
+        # has passed, the best result found so far is returned instead of
+        # waiting for the rest of the variants to be scored.
+        # If supersede is True, starting this call tells any earlier call
+        # that is still running to give up, and that call returns None.
+        # Cancelling the task stops the work in the worker thread too.
+        # The locale can be given like it can for determine_intent().
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        if supersede:
+            with self._async_lock:
+                if self._async_current is not None:
+                    self._async_current.set()
+                self._async_current = cancelled
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=profile.get(['naomi2_tti', 'async_workers'], 1),
+                thread_name_prefix="naomi2_tti"
+            )
+        try:
+            return await loop.run_in_executor(
+                self._executor,
+                self._determine_intent_until,
+                phrase,
+                deadline,
+                cancelled,
+                locale
+            )
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        finally:
+            with self._async_lock:
+                if self._async_current is cancelled:
+                    self._async_current = None
+
+    def _determine_intent_until(self, phrase, deadline, cancelled, locale=None):
+        if cancelled.is_set():
+            return None
+        plugin = self._for_locale(locale)
+        if plugin._pending:
+            plugin.train()
+        phrase = self.cleantext(phrase)
+        result = plugin._cache.get(phrase)
+        if result is not None:
+            return result
+        stopped = []
+
+        def stop():
+            if cancelled.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                stopped.append(True)
+                return True
+            return False
+
+        intent, result = plugin._determine_intent(phrase, stop=stop)
+        if cancelled.is_set():
+            return None
+        # Only keep complete results
+        if not stopped:
+            plugin._cache.put(phrase, result)
+        return result
+
+    def enable_stats(self, hook=None):
+        # Start timing the stages of determine_intent() and counting the
+        # work it does. If given, hook is called with the record of each
+        # call (see intent_stats.IntentStats).
+        if self._stats is None:
+            self._stats = intent_stats.IntentStats()
+        if hook is not None:
+            self._stats.hooks.append(hook)
+
+    def disable_stats(self):
+        self._stats = None
+
+    def get_stats(self):
+        if self._stats is None:
+            return None
+        return self._stats.summary()
+
+    def determine_intents(self, phrases, workers=1, seed=None):
+        # Determine the intents of a list of phrases, for instance when
+        # relabelling logged transcripts, and return the results in the
+        # same order. With more than one worker the phrases are spread
+        # over a pool of forked processes, which share the trained model
+        # with this one instead of copying it. Ties between intents are
+        # broken at random, so pass a seed to get the same results every
+        # time (each phrase gets its own random number generator, seeded
+        # from the seed and its position, so the number of workers does
+        # not matter). The cache is not used.
+        # Forking only copies the calling thread, so a lock another thread
+        # holds at the time stays locked in the workers. They only score
+        # phrases against the model, which takes none of the plugin's
+        # locks, but the model must not be changed (by add_intents() or
+        # set_locale() in another thread) while they are being forked.
+        if self._pending:
+            self.train()
+        jobs = [(position, phrase, seed) for position, phrase in enumerate(phrases)]
+        if workers > 1 and len(jobs) > 1:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_batch_start,
+                    initargs=(self,)
+                ) as executor:
+                    answers = list(executor.map(
+                        _batch_determine_intent,
+                        jobs,
+                        chunksize=max(1, len(jobs) // (workers * 4))
+                    ))
+            else:
+                self._logger.warning(
+                    "Processes can't be forked here, using a single process"
+                )
+                answers = [self._batch_item(*job) for job in jobs]
+        else:
+            answers = [self._batch_item(*job) for job in jobs]
+        # Put the actions back, since they can't be sent between processes
+        results = []
+        for intent, result in answers:
+            for name in result:
+                result[name]['action'] = self.intent_map['intents'][intent]['action']
+            results.append(result)
+        return results
+
+    def _batch_item(self, position, phrase, seed):
+        rng = random
+        if seed is not None:
+            rng = random.Random(f"{seed}:{position}")
+        intent, result = self._determine_intent(self.cleantext(phrase), rng)
+        for name in result:
+            result[name]['action'] = None
+        return intent, result
+
+    def cache_info(self):
+        return {
+            'hits': self._cache.hits,
+            'misses': self._cache.misses,
+            'size': len(self._cache),
+            'maxsize': self._cache.size
+        }
+
+    def _aligner(self):
+        try:
+            return self._local.aligner
+        except AttributeError:
+            self._local.aligner = Aligner()
+            return self._local.aligner
+
+    def _determine_intent(
+        self,
+        phrase,
+        rng=random,
+        record=None,
+        trace=None,
+        stop=None,
+        only_intent=None
+    ):
         # replace any keyword found in the utterance with the name of the keyword group.
         # This way if the user says "I am happy" and we have the following
         # intents:
@@ -219,245 +1291,169 @@ class Naomi2TTIPlugin(plugin.TTIPlugin):
         # In both of these cases, the "I AM" part of the request, despite
         # the fact that both words are very common, will determine the
         # intent.
-        for intent in self.keywords:
-            variants = {phrase: {}}
-            for keyword in self.keywords[intent]:
-                for word in self.keywords[intent][keyword]:
-                    count = 0  # count is the index of the match we are looking for
-                    countadded = 0  # keep track of variants added for this count
-                    while True:
-                        added = 0  # if we get through all the variants without
-                        # adding any new variants, then increase the count.
-                        for variant in variants:
-                            # subs is a list of substitutions
-                            # We create a copy so we can only add a new
-                            # substitution to the list if it does not already
-                            # exist
-                            subs = dict(variants[variant])
-                            # check and see if we can make a substitution and
-                            # generate a new variant.
-                            new = self.replacenth(word, "{}{}{}".format('{', keyword, '}'), variant, count)
-                            if new not in variants:
-                                try:
-                                    subs[keyword].append(word)
-                                except KeyError:
-                                    subs[keyword] = [word]
-                                # print(subs[keyword])
-                                # print()
-                                variants[new] = subs
-                                # pprint(variants)
-                                added += 1
-                                countadded += 1
-                                # start looping over variants again
-                                break
-                        # check if we were able to loop over all the variants
-                        # without creating any new ones
-                        if added == 0:
-                            if countadded == 0:
-                                break
-                            else:
-                                count += 1
-                                countadded = 0
-            allvariants.update(variants)
-        # pdb.set_trace()
-        # Now calculate a total score for each variant
+        # Variants are generated lazily, most promising first. Stop once
+        # no remaining variant can beat the best score, or once we have
+        # scored max_variants of them.
         variantscores = {}
-        for variant in allvariants:
-            self._logger.debug("************VARIANT**************")
-            self._logger.debug(variant)
-            variantscores[variant] = {}
-            words = variant.split()
-            intentscores = {}
-            # pdb.set_trace()
-            for intent in self.intent_map['intents']:
-                self._logger.debug(f"Intent: {intent}")
-                intentscores[intent] = 0
-                # pprint(self.intent_map['intents'][intent]['words'])
-                # build up a score based on the words that match.
-                for template in self.intent_map['intents'][intent]['templates']:
-                    self._logger.debug(f"Scoring template: {template}")
-                    score = 0
-                    template_words = template.split()
-                    # Split the template into words, and get the total words
-                    # that match between the template and the variant.
-                    for word in words:
-                        self._logger.debug(f"Scoring word: {word}")
-                        if word in template_words:
-                            try:
-                                score += 1/self.words[word] # Add 1/count, more popular words have less weight
-                            except KeyError:
-                                pass
-                            self._logger.debug(f"Score: {score}")
-                    if score > intentscores[intent]:
-                        intentscores[intent]=score
-                self._logger.debug(f"{intent}: {score}")
-            # Take the intent with the highest score
-            bestintent = max(intentscores, key=intentscores.get)
-            bestscore = intentscores[bestintent]
-            # Check if there are multiple intents with the same score.
-            intents = [k for k,v in intentscores.items() if v == bestscore]
-            if len(intents) > 1:
-                # Choose one at random
-                self._logger.info(f"Choosing at random from {intents}") 
-                bestintent = random.choice(intents)
-            variantscores[variant] = {
-                'intent': bestintent,
-                'input': phrase,
-                'score': bestscore,
-                'matches': allvariants[variant],
-                'action': self.intent_map['intents'][bestintent]['action']
-            }
+        topscore = None
+        limit = None
+        if record is not None:
+            started = time.perf_counter()
+            templates_scored = self._templates_scored
+        words = phrase.split()
+        variants = self._variants(words, stop)
+        batch = 64 if self._scoring == 'numpy' else 1
+        done = False
+        while not done:
+            # Once we have something to go on, stop() can cut the search
+            # short and we go with the best variant scored so far
+            if stop is not None and variantscores and stop():
+                self._logger.info(
+                    f"Stopped early after scoring {len(variantscores)} variants"
+                )
+                break
+            chunk = list(itertools.islice(variants, batch))
+            if record is not None:
+                started = intent_stats.lap(record, 'variants', started)
+                record['counts']['variants'] += len(chunk)
+            if not chunk:
+                break
+            scores = self._score_variants(
+                [variant for bound, variant, matches, spans in chunk]
+            )
+            for bound, variant, matches, spans in chunk:
+                # Allow for rounding differences between the bound and the
+                # score, which sum the same weights in a different order.
+                if limit is not None and bound <= limit + 1e-9:
+                    done = True
+                    break
+                # Always score at least one variant, even with
+                # max_variants set to 0
+                if len(variantscores) >= max(self._max_variants, 1):
+                    self._logger.info(
+                        f"Stopped after scoring {len(variantscores)} variants"
+                    )
+                    done = True
+                    break
+                intentscores = next(scores)
+                if trace is not None:
+                    # Remember the best variant for every intent, to
+                    # explain the winner and the runner up afterwards
+                    text = " ".join(self._variant_words(words, spans))
+                    for intent in intentscores:
+                        if intent not in trace or intentscores[intent] > trace[intent][0]:
+                            trace[intent] = (intentscores[intent], text)
+                # Take the intent with the highest score
+                bestintent = max(intentscores, key=intentscores.get)
+                if only_intent is not None:
+                    # or the intent we already know it is for, and just
+                    # need the variant and matches for
+                    bestintent = only_intent
+                bestscore = intentscores[bestintent]
+                # Check if there are multiple intents with the same score.
+                intents = [k for k,v in intentscores.items() if v == bestscore]
+                if len(intents) > 1 and only_intent is None:
+                    # Choose one at random
+                    self._logger.info(f"Choosing at random from {intents}") 
+                    bestintent = rng.choice(intents)
+                variantscores[variant] = {
+                    'intent': bestintent,
+                    'spans': spans,
+                    'input': phrase,
+                    'score': bestscore,
+                    'matches': matches,
+                    'action': self.intent_map['intents'][bestintent]['action']
+                }
+                if topscore is None or bestscore > topscore:
+                    topscore = bestscore
+                limit = topscore
+                if trace is not None and len(trace) > 1:
+                    # To explain the runner up, its best variant has to be
+                    # scored too, so only stop once nothing can beat it
+                    limit = heapq.nlargest(
+                        2,
+                        [score for score, text in trace.values()]
+                    )[1]
+            if record is not None:
+                started = intent_stats.lap(record, 'scoring', started)
+        if record is not None:
+            record['counts']['templates_scored'] = (
+                self._templates_scored - templates_scored
+            )
         bestvariant = max(variantscores, key=lambda key: variantscores[key]['score'])
-        # find the template with the smallest levenshtein distance
-        templates = {}
-        for template in self.intent_map['intents'][bestintent]['templates']:
-            templates[template] = wer(template, variant)
-        besttemplate = min(templates, key=templates.get)
-        # The next thing we have to do is match up all the substitutions
-        # that have been made between the template and the current variant
-        # This is so that if there are multiple match indicators we can eliminate
-        # the ones that have matched.
-        # Consider the following:
+        # A multi-word keyword value like "HAPPY TOGETHER" scores no more
+        # than a shorter value it starts with, like "HAPPY", so the
+        # variant that won may have cut it short
+        best = variantscores[bestvariant]
+        if best['spans']:
+            bestvariant, best['matches'], best['spans'] = self._widen_spans(
+                words,
+                bestvariant,
+                best
+            )
+            variantscores[bestvariant] = best
+        # Find the template closest to the best variant. Aligning the two
+        # also tells us the values of any slots in the template we have not
+        # filled in yet, like open or regex keywords, or a second {Team}
+        # where the variant only had one team we recognized:
         #   Team: ['bengals','patriots']
         #   Template: will the {Team} play the {Team} {Day}
         #   Input: will done browns play the bengals today
-        #   Input with matches: will done browns play the {Team} {Day}
-        #   Matches: {Team: bengals, Day: today}
-        # Obviously there is a very low Levenshtein distance between the template
-        # and the input with matches, but it's not that easy to figure out which
-        # Team in the template has been matched. So loop through the matches and
-        # words and match the word with each possible location in the template
-        # and take the best as the new template.
-        #   Template1: will the bengals play the {Team} {Day}
-        #   input: will done browns play the bengals {Day}
-        #   distance: .42
-        #
-        #   Template2: will the {Team} play the bengals {Day}
-        #   input: will done browns play the bengals {Day}
-        #   distance: .28
-        #
-        # since we are looking for the smallest distance, Template2 is obviously
-        # a better choice.
-        # print("Best variant: {}".format(bestvariant))
-        # print("Best template: {}".format(besttemplate))
-        currentvariant = bestvariant
-        currenttemplate = besttemplate
-        for matchlist in variantscores[bestvariant]['matches']:
-            for word in variantscores[bestvariant]['matches'][matchlist]:
-                # Substitute word into the variant (we know this matches the
-                # first occurrance of {matchlist})
-                currentvariant = bestvariant.replace(
-                    "{}{}{}".format('{', matchlist, '}'),
-                    word,
-                    1
-                )
-                templates = {}
-                # Get a count of the number of matches for the
-                # current matchlist in template
-                possiblesubstitutions = currenttemplate.count(
-                    '{}{}{}'.format('{', matchlist, '}')
-                )
-                # We don't actually know if there are actually any
-                # substitutions in the template
-                if(possiblesubstitutions > 0):
-                    for i in range(possiblesubstitutions):
-                        currenttemplate = self.replacenth(
-                            '{}{}{}'.format('{', matchlist, '}'),
-                            word,
-                            currenttemplate,
-                            i + 1
-                        )
-                        templates[currenttemplate] = wer(
-                            currentvariant,
-                            currenttemplate
-                        )
-                    currenttemplate = min(
-                        templates,
-                        key=lambda key: templates[key]
-                    )
-        # Now that we have a matching template, run through a list of all
-        # substitutions in the template and see if there are any we have not
-        # identified yet.
-        substitutions = re.findall(r'{(.*?)}', currenttemplate)
-        if(substitutions):
-            for substitution in substitutions:
-                subvar = "{}{}{}".format('{', substitution, '}')
-                # So now we know that we are missing the variable contained
-                # in substitution.
-                # What we have to do now is figure out where in the string
-                # to insert that variable in order to minimize the levenshtein
-                # distance between bestvariant and besttemplate
-                variant = currentvariant.split()
-                variant.append("<END>")
-                template = currenttemplate.split()
-                template.append("<END>")
-                n = len(variant) + 1
-                m = len(template) + 1
-                # Find out which column contains the first instance of
-                # substitution
-                s = template.index(subvar) + 1
-                match = []
-                a = []
-                for i in range(n + 1):
-                    a.append([1] * (m + 1))
-                    a[i][0] = i
-                for j in range(m + 1):
-                    a[0][j] = j
-                for i in range(1, n):
-                    for j in range(1, m):
-                        if(variant[i - 1] == template[j - 1]):
-                            c = 0
-                        else:
-                            c = 1
-                        a[i][j] = c
-                # examine the resulting list of matched words
-                # to locate the position of the unmatched keyword
-                matched = ""
-                for i in range(1, n - 1):
-                    if(a[i - 1][s - 1] == 0):
-                        # the previous item was a match
-                        # so start here and work to the right until there is
-                        # another match
-                        k = i
-                        start = k
-                        end = n - 1
-                        compare = [k]
-                        compare.extend([1] * (m))
-                        while((a[k] == compare) and (k < (n))):
-                            match.append(variant[k - 1])
-                            k += 1
-                            compare = [k]
-                            compare.extend([1] * (m))
-                            end = k
-                        matched = " ".join(match)
-                        substitutedvariant = variant[:start]
-                        substitutedvariant.append(subvar)
-                        substitutedvariant.extend(variant[end:])
-                        break
-                    elif(a[i + 1][s + 1] == 0):
-                        # the next item is a match, so start working backward
-                        k = i
-                        end = k
-                        start = 0
-                        compare = [k]
-                        compare.extend([1] * (m))
-                        while(a[k] == compare):
-                            match.append(variant[k - 1])
-                            k -= 1
-                            compare = [k]
-                            compare.extend([1] * (m))
-                            start = k
-                        matched = " ".join(reversed(match))
-                        substitutedvariant = variant[:start]
-                        substitutedvariant.append(subvar)
-                        substitutedvariant.extend(variant[end:])
-                        break
-                if(len(matched)):
-                    try:
-                        variantscores[bestvariant]['matches'][substitution].append(matched)
-                    except KeyError:
-                        variantscores[bestvariant]['matches'][substitution] = [matched]
-        return {
+        #   Variant: will done browns play the {Team} today
+        #   Slots: {Team: done browns, Day: today}
+        # The distance is divided by the length of the template, like a
+        # word error rate, so longer templates are not penalized.
+        bestintent = variantscores[bestvariant]['intent']
+        bestdistance = None
+        aligner = self._aligner()
+        # Open keywords (like regex or free text ones), which have no list
+        # of values, can take the variant's other words as values. The
+        # values of the others have already been found by the spotter, so
+        # they only can for the slots the variant has no value for, like
+        # the second {Team} above.
+        closed = self.keywords.get(bestintent, {})
+        counts = {}
+        for token in bestvariant:
+            counts[token] = counts.get(token, 0) + 1
+
+        def is_open(token, template):
+            return(
+                self._tokens.word(token)[1:-1] not in closed
+                or counts.get(token, 0) < template.count(token)
+            )
+
+        for template in self._templates[bestintent]:
+            distance, slots = aligner.align(
+                bestvariant,
+                template,
+                self._tokens.is_slot,
+                lambda token: is_open(token, template)
+            )
+            distance /= max(len(template), 1)
+            if bestdistance is None or distance < bestdistance:
+                bestdistance = distance
+                besttemplate = template
+                bestslots = slots
+        if record is not None:
+            intent_stats.lap(record, 'alignment', started)
+            record['counts']['alignments'] = len(
+                self.intent_map['intents'][bestintent]['templates']
+            )
+        if bestdistance is not None:
+            variantwords = self._variant_words(
+                words,
+                variantscores[bestvariant]['spans']
+            )
+            for position, start, end in bestslots:
+                substitution = self._tokens.word(besttemplate[position])[1:-1]
+                matched = " ".join(variantwords[start:end])
+                try:
+                    variantscores[bestvariant]['matches'][substitution].append(matched)
+                except KeyError:
+                    variantscores[bestvariant]['matches'][substitution] = [matched]
+        # Also return the intent the result is for, which can differ from
+        # the name in the result if two plugins used the same intent name
+        return variantscores[bestvariant]['intent'], {
             self.intent_map['intents'][variantscores[bestvariant]['intent']]['name']: {
                 'action': variantscores[bestvariant]['action'],
                 'input': phrase,
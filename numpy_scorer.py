@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Scores a batch of variants against every template at once.
+#
+# The templates are numbered in intent order, and for every word we keep
+# an array of the templates that contain it along with an array holding
+# the word's weight once for each of those templates. Together these are
+# the columns of a sparse word by template matrix. Scoring a batch of
+# variants multiplies their bag of words vectors by that matrix: we gather
+# the columns for every token of every variant (offsetting the template
+# numbers by the variant's position in the batch) and add them up with a
+# single np.bincount.
+#
+# np.bincount adds the weights in the order they are given, which is the
+# order of the words in each variant, so every template gets exactly the
+# same floating point score as Naomi2TTIPlugin._score_variant() would give
+# it and ties are broken the same way.
+class NumpyScorer(object):
+    def __init__(self, intent_map, index, weights):
+        self._intents = list(intent_map['intents'])
+        numbers = {}
+        starts = []
+        self._scored_intents = []
+        for intent in self._intents:
+            templates = intent_map['intents'][intent]['templates']
+            if templates:
+                starts.append(len(numbers))
+                self._scored_intents.append(intent)
+            for number in range(len(templates)):
+                numbers[(intent, number)] = len(numbers)
+        self.template_count = len(numbers)
+        self._starts = np.array(starts, dtype=np.intp)
+        self._columns = {}
+        for word in index:
+            if word in weights:
+                templates = np.array(
+                    [numbers[template] for template in index[word]],
+                    dtype=np.intp
+                )
+                self._columns[word] = (
+                    templates,
+                    np.full(len(templates), weights[word])
+                )
+
+    # Takes a list of variants, each a tuple of tokens, and returns a list
+    # with the score of each intent's best template for each variant, in
+    # the same form as Naomi2TTIPlugin._score_variant()
+    def score(self, variants):
+        templates = []
+        weights = []
+        for position, words in enumerate(variants):
+            offset = position * self.template_count
+            for word in words:
+                try:
+                    column = self._columns[word]
+                except KeyError:
+                    continue
+                templates.append(column[0] + offset)
+                weights.append(column[1])
+        results = []
+        if templates and self._scored_intents:
+            scores = np.bincount(
+                np.concatenate(templates),
+                weights=np.concatenate(weights),
+                minlength=len(variants) * self.template_count
+            ).reshape(len(variants), self.template_count)
+            best = np.maximum.reduceat(scores, self._starts, axis=1).tolist()
+        else:
+            best = [[0] * len(self._scored_intents) for words in variants]
+        for row in best:
+            intentscores = {intent: 0 for intent in self._intents}
+            for intent, score in zip(self._scored_intents, row):
+                # Intents that don't match at all score 0, not 0.0
+                if score > 0:
+                    intentscores[intent] = score
+            results.append(intentscores)
+        return results
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import pickle
+
+# Increase this whenever the layout of the saved model changes, so
+# snapshots written by an older version of the plugin are ignored.
+SNAPSHOT_VERSION = 4
+
+_logger = logging.getLogger(__name__)
+
+
+# A snapshot is a pickled dictionary:
+#   {
+#       'version': SNAPSHOT_VERSION,
+#       'key': a hash of the intents the model was trained on,
+#       'model': the trained model, using only built in types
+#   }
+# Returns the model if the file holds a snapshot of the current version
+# with a matching key, otherwise None.
+def load(filename, key):
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        _logger.warning(f"Unable to read model snapshot {filename}: {e}")
+        return None
+    if not isinstance(snapshot, dict):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    if snapshot.get('key') != key:
+        return None
+    return snapshot.get('model')
+
+
+# Write the snapshot to a temporary file first and then move it into
+# place, so a crash while saving never leaves a truncated snapshot behind.
+# Failing to save is not fatal, we will just have to train next time too.
+def save(filename, key, model):
+    temporary = f"{filename}.tmp"
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(temporary, 'wb') as f:
+            pickle.dump(
+                {'version': SNAPSHOT_VERSION, 'key': key, 'model': model},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(temporary, filename)
+    except Exception as e:
+        _logger.warning(f"Unable to save model snapshot {filename}: {e}")
@@ -1,9 +1,835 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 from naomi import testutils
-from . import naomi_tti
+from . import alignment
+from . import keyword_spotter
+from . import naomi2_tti
+from . import numpy_scorer
+from . import snapshot
 
 
-class TestNaomiTTIPlugin(unittest.TestCase):
+def handle(intent, mic):
+    pass
+
+
+INTENTS = {
+    'TimeIntent': {
+        'locale': {
+            'en-US': {
+                'templates': [
+                    "WHAT TIME IS IT",
+                    "TELL ME THE TIME"
+                ]
+            }
+        },
+        'action': handle
+    },
+    'HowAreYouIntent': {
+        'locale': {
+            'en-US': {
+                'keywords': {
+                    'MoodKeyword': ['HAPPY', 'SAD', 'EXCITED']
+                },
+                'templates': [
+                    "I AM {MoodKeyword}",
+                    "I FEEL {MoodKeyword}"
+                ]
+            }
+        },
+        'action': handle
+    },
+    'MPDIntent': {
+        'locale': {
+            'en-US': {
+                'keywords': {
+                    'Playlist': [
+                        'HAPPY',
+                        'HAPPY TOGETHER',
+                        "I'M",
+                        "I'M SO EXCITED"
+                    ]
+                },
+                'templates': [
+                    "PLAY {Playlist}",
+                    "WHAT IS PLAYING"
+                ]
+            }
+        },
+        'action': handle
+    },
+    'TimerIntent': {
+        'locale': {
+            'en-US': {
+                'templates': [
+                    "SET A TIMER FOR {Duration}",
+                    "WHAT TIME IS LEFT ON THE TIMER"
+                ]
+            }
+        },
+        'action': handle
+    },
+    'SportsIntent': {
+        'locale': {
+            'en-US': {
+                'keywords': {
+                    'Team': ['BENGALS', 'BROWNS', 'PATRIOTS']
+                },
+                'templates': [
+                    "WILL THE {Team} PLAY THE {Team} {Day}"
+                ]
+            }
+        },
+        'action': handle
+    }
+}
+
+
+class TestNaomi2TTIPlugin(unittest.TestCase):
     def setUp(self):
-        self.plugin = testutils.get_plugin_instance(naomi_tti.NaomiTTIPlugin)
+        self.plugin = testutils.get_plugin_instance(
+            naomi2_tti.Naomi2TTIPlugin
+        )
+        self.plugin._snapshot_file = None
+
+    def test_incremental_training(self):
+        self.plugin.train()
+        self.plugin.add_intents({'TimeIntent': INTENTS['TimeIntent']})
+        self.plugin.add_intents({
+            'HowAreYouIntent': INTENTS['HowAreYouIntent'],
+            'MPDIntent': INTENTS['MPDIntent']
+        })
+        self.plugin.remove_intents(['HowAreYouIntent'])
+        self.plugin.add_intents({'TimerIntent': INTENTS['TimerIntent']})
+
+        full = testutils.get_plugin_instance(naomi2_tti.Naomi2TTIPlugin)
+        full._snapshot_file = None
+        full.add_intents({
+            'TimeIntent': INTENTS['TimeIntent'],
+            'MPDIntent': INTENTS['MPDIntent'],
+            'TimerIntent': INTENTS['TimerIntent']
+        })
+        full.train()
+        self.assertEqual(self.plugin._dump_model(), full._dump_model())
+
+        # Retraining from scratch does not change the incremental model
+        incremental = self.plugin._dump_model()
+        self.plugin.train()
+        self.assertEqual(self.plugin._dump_model(), incremental)
+
+    def test_matches(self):
+        self.plugin.add_intents(INTENTS)
+        # (utterance, intent, matches)
+        cases = [
+            (
+                "set a timer for five minutes",
+                'TimerIntent',
+                {'Duration': ["FIVE MINUTES"]}
+            ),
+            (
+                "set a timer five minutes",
+                'TimerIntent',
+                {'Duration': ["FIVE MINUTES"]}
+            ),
+            (
+                "play i'm so excited",
+                'MPDIntent',
+                {'Playlist': ["I'M SO EXCITED"]}
+            ),
+            (
+                "play happy together",
+                'MPDIntent',
+                {'Playlist': ["HAPPY TOGETHER"]}
+            ),
+            (
+                "i am excited i am sad",
+                'HowAreYouIntent',
+                {'MoodKeyword': ["EXCITED", "SAD"]}
+            ),
+            (
+                "will the browns play the bengals today",
+                'SportsIntent',
+                {'Team': ["BROWNS", "BENGALS"], 'Day': ["TODAY"]}
+            ),
+            (
+                # The second team is not one we know, but the template
+                # has a {Team} left for it
+                "will the jets play the bengals today",
+                'SportsIntent',
+                {'Team': ["BENGALS", "JETS"], 'Day': ["TODAY"]}
+            ),
+            (
+                # The mood is found by the spotter, so VERY is not part of it
+                "i am very happy",
+                'HowAreYouIntent',
+                {'MoodKeyword': ["HAPPY"]}
+            )
+        ]
+        for utterance, intent, matches in cases:
+            result = self.plugin.determine_intent(utterance)
+            self.assertEqual(list(result), [intent], utterance)
+            self.assertEqual(result[intent]['matches'], matches, utterance)
+
+    def test_overlapping_keyword_spans(self):
+        # Every word of the utterance, and every pair of words next to
+        # each other, is a keyword value. There are far too many ways of
+        # substituting them to try them all, but the best ones are found
+        # straight away.
+        words = ["W{}".format(number) for number in range(60)]
+        values = words + [
+            "{} {}".format(first, second)
+            for first, second in zip(words, words[1:])
+        ]
+        self.plugin.add_intents({
+            'SongIntent': {
+                'locale': {
+                    'en-US': {
+                        'keywords': {'Song': values},
+                        'templates': ["PLAY {Song}"]
+                    }
+                },
+                'action': handle
+            },
+            'OtherIntent': {
+                'locale': {
+                    'en-US': {
+                        'templates': ["PLAY SOMETHING ELSE"]
+                    }
+                },
+                'action': handle
+            }
+        })
+        self.plugin.enable_stats()
+        result = self.plugin.determine_intent("play " + " ".join(words))
+        self.assertEqual(list(result), ['SongIntent'])
+        self.assertLessEqual(
+            self.plugin.get_stats()['last']['counts']['variants'],
+            3
+        )
+
+    def add_tied_intents(self, count):
+        # Two keyword groups with the same values give every word two
+        # spans that are just as good as each other. Returns an utterance
+        # of count of those words.
+        common = ["THE", "LOVE", "YOU", "ME", "ALL", "NEED", "IS", "MY"]
+        self.plugin.add_intents({
+            'SongIntent': {
+                'locale': {
+                    'en-US': {
+                        'keywords': {'Song': common, 'Artist': common},
+                        'templates': ["PLAY {Song} BY {Artist}"]
+                    }
+                },
+                'action': handle
+            },
+            'TimeIntent': INTENTS['TimeIntent']
+        })
+        self.plugin.train()
+        words = [common[number % len(common)] for number in range(count)]
+        return "play " + " ".join(words)
+
+    def test_tied_keyword_spans(self):
+        # There are 3 ** 80 equally good ways of substituting the spans
+        utterance = self.add_tied_intents(80)
+        self.plugin._max_variants = 1
+        self.plugin.enable_stats()
+        result = self.plugin.determine_intent(utterance)
+        self.assertEqual(list(result), ['SongIntent'])
+        self.assertLessEqual(
+            self.plugin.get_stats()['last']['counts']['variants'],
+            2
+        )
+
+    def test_async_deadline(self):
+        # Scoring all of this takes seconds
+        utterance = self.add_tied_intents(5000)
+        started = time.monotonic()
+        result = asyncio.run(
+            self.plugin.determine_intent_async(utterance, deadline=started)
+        )
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(result), 1)
+        # The best result so far is not kept
+        self.assertEqual(self.plugin.cache_info()['size'], 0)
+
+    def test_async_supersede(self):
+        utterance = self.add_tied_intents(5000)
+
+        async def run():
+            first = asyncio.ensure_future(
+                self.plugin.determine_intent_async(utterance)
+            )
+            await asyncio.sleep(0.05)
+            started = time.monotonic()
+            second = await self.plugin.determine_intent_async(
+                "what time is it"
+            )
+            return time.monotonic() - started, await first, second
+
+        elapsed, first, second = asyncio.run(run())
+        self.assertLess(elapsed, 1)
+        self.assertIsNone(first)
+        self.assertEqual(list(second), ['TimeIntent'])
+
+    def test_async_cancel(self):
+        utterance = self.add_tied_intents(5000)
+
+        async def run():
+            task = asyncio.ensure_future(
+                self.plugin.determine_intent_async(utterance, supersede=False)
+            )
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The worker thread gave up too, so it is free for this
+            started = time.monotonic()
+            result = await self.plugin.determine_intent_async(
+                "what time is it",
+                supersede=False
+            )
+            return time.monotonic() - started, result
+
+        elapsed, result = asyncio.run(run())
+        self.assertLess(elapsed, 1)
+        self.assertEqual(list(result), ['TimeIntent'])
+
+    def test_plugin_phrases(self):
+        self.plugin.add_intents(INTENTS)
+        self.plugin.train()
+        intents = self.plugin.intent_map['intents']
+        templates = {
+            intent: list(intents[intent]['templates']) for intent in intents
+        }
+        phrases = self.plugin.get_plugin_phrases()
+        self.assertEqual(self.plugin.get_plugin_phrases(), phrases)
+        # Expanding the keywords leaves the templates alone
+        self.assertEqual(
+            {
+                intent: self.plugin.intent_map['intents'][intent]['templates']
+                for intent in self.plugin.intent_map['intents']
+            },
+            templates
+        )
+        self.assertIn("PLAY HAPPY TOGETHER", phrases)
+        self.assertIn("PLAY I'M SO EXCITED", phrases)
+        # Only keywords without a list of values are left as they are
+        self.assertIn("SET A TIMER FOR {Duration}", phrases)
+        self.assertFalse([
+            phrase for phrase in phrases
+            if "{Playlist}" in phrase or "{Team}" in phrase
+        ])
+
+    def test_max_phrase_expansions(self):
+        self.plugin.add_intents({'MPDIntent': INTENTS['MPDIntent']})
+        self.plugin._max_phrase_expansions = 2
+        phrases = self.plugin.get_plugin_phrases()
+        self.assertEqual(
+            len([phrase for phrase in phrases if phrase.startswith("PLAY ")]),
+            2
+        )
+        self.assertIn("WHAT IS PLAYING", phrases)
+
+    def test_standard_phrases(self):
+        self.plugin.add_intents({'TimeIntent': INTENTS['TimeIntent']})
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "en-US.txt")
+            with open(filename, 'w') as f:
+                f.write("hello there\n")
+            with mock.patch.object(
+                naomi2_tti.paths,
+                'data',
+                lambda *parts: os.path.join(directory, *parts[1:])
+            ):
+                self.assertIn("HELLO THERE", self.plugin.get_plugin_phrases())
+                with open(filename, 'w') as f:
+                    f.write("good night\n")
+                modified = os.path.getmtime(filename) + 10
+                os.utime(filename, (modified, modified))
+                phrases = self.plugin.get_plugin_phrases()
+            self.assertIn("GOOD NIGHT", phrases)
+            self.assertNotIn("HELLO THERE", phrases)
+            self.assertIn("WHAT TIME IS IT", phrases)
+
+    def test_determine_intents(self):
+        self.plugin.add_intents(INTENTS)
+        phrases = [
+            "what time is it",
+            "set a timer for five minutes",
+            "i am excited i am sad",
+            "play happy together",
+            "will the browns play the bengals today",
+            # Ties between intents, broken at random
+            "the",
+            "play",
+            "i am"
+        ] * 3
+        results = self.plugin.determine_intents(phrases, workers=1, seed=7)
+        self.assertEqual(
+            self.plugin.determine_intents(phrases, workers=3, seed=7),
+            results
+        )
+        for phrase, result in zip(phrases, results):
+            self.assertEqual(len(result), 1, phrase)
+            for name in result:
+                # In the same order as the phrases, with the actions
+                # put back
+                self.assertEqual(
+                    result[name]['input'],
+                    self.plugin.cleantext(phrase)
+                )
+                self.assertIs(result[name]['action'], handle)
+        self.assertIsNone(naomi2_tti._batch_plugin)
+
+    def test_intent_for_another_locale(self):
+        self.plugin.set_locale('fr-FR')
+        # Registered, but left out of the model for fr-FR
+        self.plugin.add_intents({'TimeIntent': INTENTS['TimeIntent']})
+        self.plugin.train()
+        self.assertNotIn('TimeIntent', self.plugin.intent_map['intents'])
+        self.plugin.set_locale('en-US')
+        result = self.plugin.determine_intent("what time is it")
+        self.assertEqual(list(result), ['TimeIntent'])
+
+    def test_locales_at_the_same_time(self):
+        self.plugin.add_intents({
+            'TimeIntent': {
+                'locale': {
+                    'en-US': {'templates': ["WHAT TIME IS IT"]},
+                    'fr-FR': {'templates': ["QUELLE HEURE EST IL"]}
+                },
+                'action': handle
+            },
+            'WeatherIntent': {
+                'locale': {
+                    'en-US': {'templates': ["WHAT IS THE WEATHER"]},
+                    'fr-FR': {'templates': ["QUEL TEMPS FAIT IL"]}
+                },
+                'action': handle
+            }
+        })
+        cases = [
+            ("what time is it", 'en-US', 'TimeIntent'),
+            ("quelle heure est il", 'fr-FR', 'TimeIntent'),
+            ("what is the weather", None, 'WeatherIntent'),
+            ("quel temps fait il", 'fr-FR', 'WeatherIntent')
+        ] * 25
+        failures = []
+
+        def check(utterance, locale, intent):
+            result = self.plugin.determine_intent(utterance, locale=locale)
+            if list(result) != [intent]:
+                failures.append((utterance, locale, list(result)))
+
+        threads = [
+            threading.Thread(target=check, args=case) for case in cases
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        # The plugin itself stays on its own locale
+        self.assertEqual(self.plugin._locale, 'en-US')
+        result = asyncio.run(
+            self.plugin.determine_intent_async(
+                "quelle heure est il",
+                locale='fr-FR'
+            )
+        )
+        self.assertEqual(list(result), ['TimeIntent'])
+
+    def test_cache(self):
+        self.plugin.add_intents({'TimerIntent': INTENTS['TimerIntent']})
+        first = self.plugin.determine_intent("set a timer for five minutes")
+        # The same phrase once cleaned up
+        second = self.plugin.determine_intent("Set a timer for five minutes!")
+        self.assertEqual(second, first)
+        info = self.plugin.cache_info()
+        self.assertEqual(
+            (info['hits'], info['misses'], info['size']),
+            (1, 1, 1)
+        )
+        # Each result has its own matches lists
+        first['TimerIntent']['matches']['Duration'].append("TEN MINUTES")
+        third = self.plugin.determine_intent("set a timer for five minutes")
+        self.assertEqual(
+            third['TimerIntent']['matches'],
+            {'Duration': ["FIVE MINUTES"]}
+        )
+        self.assertIsNot(
+            third['TimerIntent']['matches']['Duration'],
+            second['TimerIntent']['matches']['Duration']
+        )
+        # Adding intents changes the model, so the cache starts again
+        self.plugin.add_intents({'TimeIntent': INTENTS['TimeIntent']})
+        self.assertEqual(self.plugin.cache_info()['size'], 0)
+        result = self.plugin.determine_intent("what time is it")
+        self.assertEqual(list(result), ['TimeIntent'])
+        self.assertEqual(self.plugin.cache_info()['misses'], 2)
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.plugin._snapshot_file = os.path.join(
+                directory,
+                "model.pickle"
+            )
+            self.plugin.add_intents(INTENTS)
+            self.plugin.train()
+            self.assertTrue(
+                os.path.exists(os.path.join(directory, "model.en-US.pickle"))
+            )
+            loaded = testutils.get_plugin_instance(naomi2_tti.Naomi2TTIPlugin)
+            loaded._snapshot_file = self.plugin._snapshot_file
+            loaded.add_intents(INTENTS)
+            with self.assertLogs(naomi2_tti.__name__, 'INFO') as logs:
+                loaded.train()
+            self.assertIn("Loaded trained model", logs.output[0])
+            self.assertEqual(loaded._dump_model(), self.plugin._dump_model())
+            result = loaded.determine_intent("set a timer for five minutes")
+            self.assertEqual(
+                result['TimerIntent']['matches'],
+                {'Duration': ["FIVE MINUTES"]}
+            )
+            # A snapshot of other intents is not used
+            filename = self.plugin._snapshot_path()
+            key = self.plugin._intents_key()
+            self.assertIsNotNone(snapshot.load(filename, key))
+            self.assertIsNone(snapshot.load(filename, "other intents"))
+            other = testutils.get_plugin_instance(naomi2_tti.Naomi2TTIPlugin)
+            other._snapshot_file = self.plugin._snapshot_file
+            other.add_intents({'TimeIntent': INTENTS['TimeIntent']})
+            self.assertNotEqual(other._intents_key(), key)
+            other.train()
+            self.assertEqual(
+                sorted(other.intent_map['intents']),
+                ['TimeIntent']
+            )
+
+    @unittest.skipIf(numpy_scorer.np is None, "NumPy is not installed")
+    def test_numpy_scoring(self):
+        self.plugin.add_intents(INTENTS)
+        scored = testutils.get_plugin_instance(naomi2_tti.Naomi2TTIPlugin)
+        scored._snapshot_file = None
+        scored._scoring = 'numpy'
+        scored.add_intents(INTENTS)
+        phrases = [
+            "what time is it",
+            "set a timer for five minutes",
+            "i am excited i am sad",
+            "will the browns play the bengals today",
+            "play the song i'm so excited",
+            "how are you feeling",
+            "what is the weather like today"
+        ]
+        # Every intent's score for every variant, not just the winner's
+        self.plugin.train()
+        scored.train()
+        variants = [
+            self.plugin._tokens.lookup(self.plugin.cleantext(phrase).split())
+            for phrase in phrases
+        ]
+        for phrase, scores, answer in zip(
+            phrases,
+            scored._score_variants(variants),
+            self.plugin._score_variants(variants)
+        ):
+            self.assertEqual(sorted(scores), sorted(answer), phrase)
+            for intent in scores:
+                self.assertAlmostEqual(
+                    scores[intent],
+                    answer[intent],
+                    msg=phrase
+                )
+        expected = self.plugin.determine_intents(phrases, seed=1)
+        results = scored.determine_intents(phrases, seed=1)
+        for phrase, result, answer in zip(phrases, results, expected):
+            self.assertEqual(list(result), list(answer), phrase)
+            for intent in result:
+                self.assertAlmostEqual(
+                    result[intent]['score'],
+                    answer[intent]['score'],
+                    msg=phrase
+                )
+                self.assertEqual(
+                    result[intent]['matches'],
+                    answer[intent]['matches'],
+                    phrase
+                )
+
+    def best_scores(self, words):
+        # Every intent's best score over every variant of the words, which
+        # is what determine_intent() finds without scoring all of them
+        if self.plugin._pending:
+            self.plugin.train()
+        scores = {}
+        variants = [
+            variant for bound, variant, matches, spans
+            in self.plugin._variants(words)
+        ]
+        for intentscores in self.plugin._score_variants(variants):
+            for intent, score in intentscores.items():
+                if score > scores.get(intent, 0):
+                    scores[intent] = score
+        return scores
+
+    def assertScoresEqual(self, scores, expected, msg=None):
+        self.assertEqual(sorted(scores), sorted(expected), msg)
+        for intent in scores:
+            self.assertAlmostEqual(scores[intent], expected[intent], msg=msg)
+
+    def test_session(self):
+        self.plugin.add_intents(INTENTS)
+        utterance = "will the browns play the bengals today"
+        session = self.plugin.start_session()
+        words = []
+        for word in utterance.split():
+            top = session.add(word)
+            words.append(word.upper())
+            self.assertScoresEqual(
+                session.scores(),
+                self.best_scores(words),
+                " ".join(words)
+            )
+        result = self.plugin.determine_intent(utterance)
+        self.assertEqual(top['intent'], 'SportsIntent')
+        self.assertAlmostEqual(top['score'], result['SportsIntent']['score'])
+        self.assertEqual(session.result(), result)
+        # The engine changing its mind about the last words
+        session.update("will the browns play the patriots")
+        self.assertScoresEqual(
+            session.scores(),
+            self.best_scores("WILL THE BROWNS PLAY THE PATRIOTS".split())
+        )
+        # A copy carries on separately
+        branch = session.copy()
+        branch.add("today")
+        self.assertEqual(session.words[-1], "PATRIOTS")
+        self.assertScoresEqual(
+            branch.scores(),
+            self.best_scores("WILL THE BROWNS PLAY THE PATRIOTS TODAY".split())
+        )
+
+    def test_nbest(self):
+        self.plugin.add_intents(INTENTS)
+        self.plugin.train()
+        hypotheses = [
+            ("will the browns play the bengals today", 0.6),
+            ("will the browns play the bengals to day", 0.3),
+            ("what time is it", 0.1)
+        ]
+        utterances = [
+            self.plugin.cleantext(phrase).split()
+            for phrase, weight in hypotheses
+        ]
+        scores = naomi2_tti.score_utterances(self.plugin, utterances)
+        for words, intentscores in zip(utterances, scores):
+            self.assertScoresEqual(
+                intentscores,
+                self.best_scores(words),
+                " ".join(words)
+            )
+        combined = {}
+        for (phrase, weight), intentscores in zip(hypotheses, scores):
+            for intent, score in intentscores.items():
+                combined[intent] = combined.get(intent, 0) + score * weight
+        nbest = self.plugin.determine_intent_nbest(hypotheses)
+        self.assertEqual(
+            [intent['intent'] for intent in nbest['ranked']],
+            sorted(combined, key=combined.get, reverse=True)
+        )
+        for intent in nbest['ranked']:
+            self.assertAlmostEqual(intent['score'], combined[intent['intent']])
+        # The winner's result is determine_intent()'s for the hypothesis it
+        # scored best on
+        self.assertEqual(
+            nbest['result'],
+            self.plugin.determine_intent(hypotheses[0][0])
+        )
+
+    def test_max_variants_zero(self):
+        self.plugin.add_intents(INTENTS)
+        self.plugin._max_variants = 0
+        result = self.plugin.determine_intent("what time is it")
+        self.assertEqual(list(result), ['TimeIntent'])
+
+    def test_explain_runner_up(self):
+        self.plugin.add_intents({
+            'SongIntent': {
+                'locale': {
+                    'en-US': {
+                        'keywords': {'Song': ['HELLO']},
+                        'templates': ["PLAY {Song}"]
+                    }
+                },
+                'action': handle
+            },
+            'HelloIntent': {
+                'locale': {
+                    'en-US': {
+                        'templates': ["PLAY HELLO WORLD"]
+                    }
+                },
+                'action': handle
+            }
+        })
+        result, explanation = self.plugin.explain_intent("play hello world")
+        self.assertEqual(
+            [
+                (intent['intent'], intent['score'], intent['variant'])
+                for intent in explanation['intents']
+            ],
+            [
+                ('HelloIntent', 2.5, "PLAY HELLO WORLD"),
+                ('SongIntent', 1.5, "PLAY {Song} WORLD")
+            ]
+        )
+
+
+class TestAligner(unittest.TestCase):
+    def test_slots(self):
+        # (template, variant, distance, slot values)
+        cases = [
+            (
+                "SET A TIMER FOR {Duration}",
+                "SET A TIMER FOR FIVE MINUTES",
+                0,
+                [("{Duration}", "FIVE MINUTES")]
+            ),
+            # A dropped word before the slot
+            (
+                "SET A TIMER FOR {Duration}",
+                "SET A TIMER FIVE MINUTES",
+                1,
+                [("{Duration}", "FIVE MINUTES")]
+            ),
+            # An extra word before the slot
+            (
+                "SET A TIMER FOR {Duration}",
+                "PLEASE SET A TIMER FOR FIVE MINUTES",
+                1,
+                [("{Duration}", "FIVE MINUTES")]
+            ),
+            # The slot does not take words that match the template
+            (
+                "SET A TIMER FOR {Duration}",
+                "SET A TIMER FOR",
+                1,
+                []
+            ),
+            (
+                "PLAY {Song} NOW",
+                "PLAY HELLO THERE NOW",
+                0,
+                [("{Song}", "HELLO THERE")]
+            ),
+            (
+                "REMIND ME TO {Task} AT {Time}",
+                "REMIND ME BUY MILK AT FIVE",
+                1,
+                [("{Task}", "BUY MILK"), ("{Time}", "FIVE")]
+            ),
+            # A slot already filled in by the spotter
+            (
+                "WILL THE {Team} PLAY THE {Team} {Day}",
+                "WILL DONE BROWNS PLAY THE {Team} TODAY",
+                1,
+                [("{Team}", "DONE BROWNS"), ("{Day}", "TODAY")]
+            )
+        ]
+        aligner = alignment.Aligner()
+        for template, variant, distance, values in cases:
+            template = template.split()
+            variant = variant.split()
+            result, slots = aligner.align(variant, template)
+            self.assertEqual(result, distance, variant)
+            self.assertEqual(
+                [
+                    (template[position], " ".join(variant[start:end]))
+                    for position, start, end in slots
+                ],
+                values,
+                variant
+            )
+
+    def test_closed_slots(self):
+        # Only open slots take words as their values
+        template = "I AM {MoodKeyword} {Reason}".split()
+        variant = "I AM VERY HAPPY".split()
+        distance, slots = alignment.Aligner().align(
+            variant,
+            template,
+            is_open=lambda word: word != "{MoodKeyword}"
+        )
+        self.assertEqual(slots, [(3, 2, 4)])
+
+
+class TestKeywordSpotter(unittest.TestCase):
+    def check_spans(self, limit):
+        spotter = keyword_spotter.KeywordSpotter(limit)
+        spotter.add('MPDIntent', 'Playlist', ["HAPPY", "I'M SO EXCITED"])
+        spotter.add('HowAreYouIntent', 'MoodKeyword', ["SO", "EXCITED"])
+        spotter.add('TimerIntent', 'Duration', ["FIVE MINUTES", "FIVE"])
+        words = "PLAY I'M SO EXCITED FOR FIVE MINUTES UNHAPPY".split()
+        self.assertEqual(
+            spotter.find(words),
+            [
+                (1, 4, 'MPDIntent', 'Playlist'),
+                (2, 3, 'HowAreYouIntent', 'MoodKeyword'),
+                (3, 4, 'HowAreYouIntent', 'MoodKeyword'),
+                (5, 6, 'TimerIntent', 'Duration'),
+                (5, 7, 'TimerIntent', 'Duration')
+            ]
+        )
+        # Only whole words match, so "UNHAPPY" is not "HAPPY", and a
+        # value that is cut short does not match
+        self.assertEqual(spotter.find("UNHAPPY I'M SO".split()), [
+            (2, 3, 'HowAreYouIntent', 'MoodKeyword')
+        ])
+
+    def test_spans(self):
+        self.check_spans(5000)
+
+    def test_spans_searched(self):
+        # The same, with every list searched instead of in the trie
+        self.check_spans(0)
+
+    def test_shared_values(self):
+        spotter = keyword_spotter.KeywordSpotter()
+        first = spotter.add('MPDIntent', 'Playlist', ["B", "A", "A"])
+        second = spotter.add('RadioIntent', 'Station', ["A", "B"])
+        self.assertIs(first, second)
+        self.assertEqual(first, ("A", "B"))
+        spotter.remove('MPDIntent', 'Playlist', ["A", "B"])
+        self.assertEqual(
+            spotter.find(["A"]),
+            [(0, 1, 'RadioIntent', 'Station')]
+        )
+        spotter.remove('RadioIntent', 'Station', ["A", "B"])
+        self.assertEqual(spotter.find(["A"]), [])
+        self.assertEqual(spotter.dump()['root'], {})
+
+    def test_remove_values(self):
+        # Removing a list leaves the trie as if it had never been added
+        spotter = keyword_spotter.KeywordSpotter()
+        spotter.add('MPDIntent', 'Playlist', ["I'M", "HAPPY TOGETHER"])
+        moods = ["I'M SO EXCITED", "HAPPY"]
+        spotter.add('HowAreYouIntent', 'MoodKeyword', moods)
+        spotter.add('RadioIntent', 'Station', ["I'M SO", "HAPPY"])
+        spotter.remove('HowAreYouIntent', 'MoodKeyword', moods)
+        expected = keyword_spotter.KeywordSpotter()
+        expected.add('MPDIntent', 'Playlist', ["I'M", "HAPPY TOGETHER"])
+        expected.add('RadioIntent', 'Station', ["I'M SO", "HAPPY"])
+        self.assertEqual(spotter.dump(), expected.dump())
+        self.assertEqual(
+            spotter.find("I'M SO EXCITED".split()),
+            [
+                (0, 1, 'MPDIntent', 'Playlist'),
+                (0, 2, 'RadioIntent', 'Station')
+            ]
+        )
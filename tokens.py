@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from array import array
+from .alignment import is_slot
+
+# The token given to words that are not in any template or keyword, so
+# they never match anything
+UNKNOWN = 0
+
+
+# Interns words as small integer tokens, so templates can be kept as
+# arrays of tokens and utterances compared against them without building
+# new strings. Tokens are handed out as words are first seen and are never
+# reused, so a token stays valid for as long as the table is around.
+class TokenTable(object):
+    def __init__(self):
+        self._tokens = {}
+        self._words = [None]
+        # 1 for every token that is a slot, like "{Duration}"
+        self._slots = bytearray(1)
+
+    def __len__(self):
+        return len(self._words)
+
+    # Return the token for a word, adding the word if it is new
+    def add(self, word):
+        try:
+            return self._tokens[word]
+        except KeyError:
+            token = len(self._words)
+            self._tokens[word] = token
+            self._words.append(word)
+            self._slots.append(1 if is_slot(word) else 0)
+            return token
+
+    # Return the token for a word, or UNKNOWN if it has not been added
+    def get(self, word):
+        return self._tokens.get(word, UNKNOWN)
+
+    def word(self, token):
+        return self._words[token]
+
+    def is_slot(self, token):
+        return self._slots[token] == 1
+
+    # A template as a compact array of tokens, adding any new words
+    def encode(self, words):
+        return array('I', [self.add(word) for word in words])
+
+    # An utterance as a tuple of tokens, without adding anything
+    def lookup(self, words):
+        return tuple([self._tokens.get(word, UNKNOWN) for word in words])